@@ -0,0 +1,319 @@
+"""
+Núcleo de la aplicación sin interfaz: localizar parcelas, evaluar afecciones y
+generar el informe PDF. Lo usan la app de Streamlit (carm.py), los lotes
+(lotes.py) y la línea de órdenes:
+
+    python -m afecciones report --x 616500 --y 4210500 --salida informe.pdf
+    python -m afecciones report --municipio Bullas --poligono 8 --parcela 48
+    python -m afecciones lote parcelas.csv salida/
+
+Los errores se devuelven como excepciones o en los resultados (estado
+"indeterminado" y su motivo) y se registran con logging; nunca se muestran.
+"""
+import logging
+import threading
+import unicodedata
+from dataclasses import dataclass
+from datetime import datetime
+
+import pandas as pd
+
+from almacen import cache
+from atlas import resultados_atlas
+from capas import consultas_afecciones, descargar_capa_o_none, evaluar_afecciones, wfs_urls
+from capas_locales import cargar_capa_local
+from coordenadas import ETRS89_UTM30, a_etrs89
+from catastro import (
+    IndiceParcelas, cargar_shapefile, construir_indice_masas, extensiones_municipios, leer_parcela, shp_urls,
+)
+from instantaneas import cargar_instantanea
+
+logger = logging.getLogger(__name__)
+
+
+# === PARCELAS E ÍNDICES (COMPARTIDOS EN EL ALMACÉN DEL PROCESO) ===
+def _leer_municipio(base_name):
+    gdf = cargar_shapefile(base_name)
+    gdf.sindex  # El índice espacial se construye una vez y se comparte
+    return gdf
+
+
+def cargar_municipio(base_name):
+    """GeoDataFrame (con sindex) de las parcelas de un municipio. Lanza excepción si no se puede obtener."""
+    return cache.obtener(("shp", base_name), lambda: _leer_municipio(base_name))
+
+
+def indice_masas(base_name):
+    """{polígono: {parcela: fila}} de un municipio, leído solo de los atributos."""
+    return cache.obtener(("masas", base_name), lambda: construir_indice_masas(base_name))
+
+
+def parcela(base_name, fila):
+    """
+    GeoDataFrame de una sola parcela por su posición en el shapefile: del
+    municipio ya cargado en el almacén si lo está y, si no, leyendo solo ese registro.
+    """
+    if ("shp", base_name) in cache:
+        return cargar_municipio(base_name).iloc[[fila]]
+    return leer_parcela(base_name, fila)
+
+
+_indice_parcelas = None
+_indice_lock = threading.Lock()
+
+
+def _cargador_tolerante(base_name):
+    try:
+        return cargar_municipio(base_name)
+    except Exception as e:
+        logger.error("Error al leer las parcelas de %s: %s", base_name, e)
+        return None
+
+
+def indice_parcelas():
+    """Índice espacial de todas las parcelas de la región (uno por proceso)."""
+    global _indice_parcelas
+    with _indice_lock:
+        if _indice_parcelas is None:
+            _indice_parcelas = IndiceParcelas(
+                _cargador_tolerante, shp_urls, extensiones_municipios(shp_urls.values())
+            )
+        return _indice_parcelas
+
+
+# === LOCALIZACIÓN: PUNTO O PARCELA COMPLETA ===
+@dataclass(frozen=True)
+class Localizacion:
+    """
+    Lo que se consulta y lo que se imprime en el informe.
+    - geom: punto (búsqueda por coordenadas) o polígono de la parcela
+    - x, y: coordenadas del punto o del centroide de la parcela
+    - municipio/masa/parcela: "N/A" si el punto no cae en ninguna parcela
+    """
+    geom: object
+    x: float
+    y: float
+    municipio: str = "N/A"
+    masa: str = "N/A"
+    parcela: str = "N/A"
+    archivo_base: str = None
+    por_parcela: bool = False
+    parcela_gdf: object = None
+
+
+def _sin_acentos(texto):
+    texto = unicodedata.normalize("NFKD", str(texto).strip().lower())
+    return "".join(c for c in texto if not unicodedata.combining(c))
+
+
+def resolver_municipio(texto):
+    """(nombre, archivo_base) de un municipio por su nombre o archivo base, sin distinguir mayúsculas ni acentos."""
+    buscado = _sin_acentos(texto).replace("_", " ")
+    for nombre, base in shp_urls.items():
+        if buscado in (_sin_acentos(nombre).replace("_", " "), _sin_acentos(base).replace("_", " ")):
+            return nombre, base
+    raise ValueError(f"Municipio desconocido: {texto}")
+
+
+def _claves_equivalentes(claves, valor):
+    """Polígonos/parcelas que coinciden con el valor tal cual o con otros ceros a la izquierda ('7' -> '007')."""
+    exactas = [valor] if valor in claves else []
+    if not valor.isdigit():
+        return exactas
+    return exactas + [c for c in claves if c != valor and c.isdigit() and int(c) == int(valor)]
+
+
+def localizar_parcela(municipio, poligono, numero):
+    """Localizacion de una parcela catastral completa. Lanza ValueError si no existe."""
+    municipio, base = resolver_municipio(municipio)
+    indice = indice_masas(base)
+    poligono, numero = str(poligono).strip(), str(numero).strip()
+    # El catastro mezcla anchos ("001" y "0001"): vale el primer polígono que tenga la parcela
+    encontradas = [
+        (masa, parcela_)
+        for masa in _claves_equivalentes(indice, poligono)
+        for parcela_ in _claves_equivalentes(indice[masa], numero)
+    ]
+    if not encontradas:
+        raise ValueError(f"Parcela no encontrada: {municipio} {poligono}/{numero}")
+    masa, parcela_ = encontradas[0]
+    parcela_gdf = parcela(base, indice[masa][parcela_])
+    geom = parcela_gdf.geometry.iloc[0]
+    if geom.geom_type not in ("Polygon", "MultiPolygon"):
+        raise ValueError("La geometría seleccionada no es un polígono válido.")
+    centroide = geom.centroid
+    return Localizacion(geom, centroide.x, centroide.y, municipio, masa, parcela_, base, True, parcela_gdf)
+
+
+def localizar_punto(x, y, crs=ETRS89_UTM30):
+    """
+    Localizacion de un punto, con la parcela que lo contiene si la hay. Las
+    coordenadas pueden venir en cualquiera de los sistemas de
+    coordenadas.CRS_ENTRADA y se pasan a ETRS89 UTM 30N. Lanza ValueError si
+    están fuera de rango.
+    """
+    from shapely.geometry import Point
+
+    x, y = (float(v) for v in a_etrs89(float(x), float(y), crs))
+    encontrado = indice_parcelas().buscar(x, y)
+    if encontrado is None:
+        return Localizacion(Point(x, y), x, y)
+    municipio, masa, parcela_, parcela_gdf = encontrado
+    return Localizacion(Point(x, y), x, y, municipio, masa, parcela_, shp_urls.get(municipio), False, parcela_gdf)
+
+
+# === AFECCIONES E INFORME ===
+def calentar_caches():
+    """Carga una vez las capas disponibles sin red (instantáneas y copias locales)."""
+    for clave in wfs_urls:
+        if cargar_instantanea(clave) is None:
+            cargar_capa_local(clave)
+
+
+def evaluar(localizacion, descargar=descargar_capa_o_none, inicializador=None, plazo=None, pool=None):
+    """
+    {clave: ResultadoAfeccion} en el orden del informe. En parcelas completas se
+    usan las capas del atlas que siguen al día; el resto se consulta en paralelo
+    (en 'pool' si se pasa uno compartido, ver capas.evaluar_afecciones).
+    """
+    precalculados = {}
+    if localizacion.por_parcela:
+        precalculados = resultados_atlas(localizacion.archivo_base, localizacion.masa, localizacion.parcela)
+    pendientes = [consulta for consulta in consultas_afecciones if consulta[0] not in precalculados]
+    en_vivo = {}
+    if pendientes:
+        opciones = {} if plazo is None else {"plazo": plazo}
+        en_vivo = evaluar_afecciones(
+            localizacion.geom, consultas=pendientes, descargar=descargar, inicializador=inicializador,
+            pool=pool, **opciones
+        )
+    return {clave: precalculados.get(clave) or en_vivo[clave] for clave, _, _ in consultas_afecciones}
+
+
+def datos_informe(localizacion, solicitante=None):
+    """Diccionario 'datos' de generar_pdf a partir de la localización y los datos del solicitante."""
+    solicitante = solicitante or {}
+    return {
+        "fecha_informe": datetime.today().strftime('%d/%m/%Y'),
+        "nombre": solicitante.get("nombre", ""), "apellidos": solicitante.get("apellidos", ""),
+        "dni": solicitante.get("dni", ""), "dirección": solicitante.get("dirección", ""),
+        "teléfono": solicitante.get("teléfono", ""), "email": solicitante.get("email", ""),
+        "objeto de la solicitud": solicitante.get("objeto de la solicitud", ""),
+        "coordenadas_x": localizacion.x, "coordenadas_y": localizacion.y,
+        "municipio": localizacion.municipio, "polígono": localizacion.masa, "parcela": localizacion.parcela,
+    }
+
+
+def generar_informe(localizacion, destino, solicitante=None, resultados=None, con_mapa=True):
+    """Evalúa (si no se pasan los resultados) y escribe el PDF en 'destino'. Devuelve los resultados."""
+    from informe import generar_pdf
+
+    if resultados is None:
+        resultados = evaluar(localizacion)
+    generar_pdf(
+        datos_informe(localizacion, solicitante), localizacion.x, localizacion.y, destino, resultados,
+        con_mapa=con_mapa,
+    )
+    return resultados
+
+
+def _valor_json(valor):
+    """Atributos que json no serializa: escalares numpy, fechas y nulos de pandas."""
+    if hasattr(valor, "item"):
+        return valor.item()
+    if hasattr(valor, "isoformat"):
+        return valor.isoformat()
+    return str(valor)
+
+
+def _limpiar(fila):
+    """NaN, NaT y NA -> None (null en JSON)."""
+    return {campo: None if pd.api.types.is_scalar(valor) and pd.isna(valor) else valor for campo, valor in fila.items()}
+
+
+def como_json(localizacion, resultados):
+    """Diccionario serializable (con json.dumps(..., default=_valor_json)) de una consulta."""
+    return {
+        "municipio": localizacion.municipio, "poligono": localizacion.masa, "parcela": localizacion.parcela,
+        "x": localizacion.x, "y": localizacion.y, "por_parcela": localizacion.por_parcela,
+        "afecciones": [
+            {
+                "clave": r.clave, "nombre": r.nombre, "estado": r.estado, "texto": r.texto,
+                "motivo": r.motivo or None, "elementos": [_limpiar(fila) for fila in r.filas],
+            }
+            for r in resultados.values()
+        ],
+    }
+
+
+# === LÍNEA DE ÓRDENES ===
+def main(argv=None):
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(prog="afecciones", description="Informes de afecciones de la CARM")
+    ordenes = parser.add_subparsers(dest="orden", required=True)
+
+    report = ordenes.add_parser("report", help="Informe de un punto o de una parcela")
+    report.add_argument("--x", type=float, help="Coordenada X ETRS89 UTM 30N")
+    report.add_argument("--y", type=float, help="Coordenada Y ETRS89 UTM 30N")
+    report.add_argument("--crs", default=ETRS89_UTM30, help="Sistema de --x/--y: EPSG:25830, EPSG:23030 o EPSG:4326 (lon, lat)")
+    report.add_argument("--municipio")
+    report.add_argument("--poligono")
+    report.add_argument("--parcela")
+    report.add_argument("--salida", help="Ruta del PDF (si se omite, solo se listan las afecciones)")
+    report.add_argument("--json", action="store_true", help="Resultado en JSON")
+    report.add_argument("--sin-mapa", action="store_true", help="No incluir el mapa de OpenStreetMap")
+    for campo in ("nombre", "apellidos", "dni", "direccion", "telefono", "email", "objeto"):
+        report.add_argument(f"--{campo}", default="")
+
+    lote = ordenes.add_parser("lote", help="Informes por lotes desde un CSV o GeoJSON")
+    lote.add_argument("entrada")
+    lote.add_argument("destino")
+    lote.add_argument("--procesos", type=int)
+    lote.add_argument("--sin-mapa", action="store_true")
+
+    parser.add_argument("-v", "--verbose", action="store_true", help="Mostrar el registro de avisos y errores")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(levelname)s %(message)s")
+
+    if args.orden == "lote":
+        from lotes import procesar_lote
+
+        procesar_lote(args.entrada, args.destino, args.procesos, con_mapa=not args.sin_mapa)
+        return 0
+
+    try:
+        if args.municipio and args.poligono and args.parcela:
+            localizacion = localizar_parcela(args.municipio, args.poligono, args.parcela)
+        elif args.x is not None and args.y is not None:
+            localizacion = localizar_punto(args.x, args.y, args.crs)
+        else:
+            parser.error("report necesita --x/--y o --municipio/--poligono/--parcela")
+    except ValueError as e:
+        logger.error("%s", e)
+        return 2
+
+    solicitante = {
+        "nombre": args.nombre, "apellidos": args.apellidos, "dni": args.dni, "dirección": args.direccion,
+        "teléfono": args.telefono, "email": args.email, "objeto de la solicitud": args.objeto,
+    }
+    if args.salida:
+        resultados = generar_informe(localizacion, args.salida, solicitante, con_mapa=not args.sin_mapa)
+    else:
+        resultados = evaluar(localizacion)
+
+    if args.json:
+        salida = dict(como_json(localizacion, resultados), pdf=args.salida)
+        print(json.dumps(salida, ensure_ascii=False, indent=1, default=_valor_json))
+    else:
+        print(f"Municipio: {localizacion.municipio}, Polígono: {localizacion.masa}, Parcela: {localizacion.parcela}")
+        for resultado in resultados.values():
+            print(f"• {resultado.texto}")
+        if args.salida:
+            print(f"Informe: {args.salida}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,241 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from io import BytesIO
+from types import MappingProxyType
+
+import numpy as np
+import pandas as pd
+
+# Presupuesto de memoria por defecto del almacén del proceso (MB)
+CACHE_MB = float(os.environ.get("AFECCIONES_CACHE_MB", "400"))
+# Segundos entre intentos de revalidar una entrada caducada cuyo refresco falló
+REINTENTO_REVALIDAR = 300
+
+
+# === CONGELAR Y ENTREGAR VALORES COMPARTIDOS ===
+def congelar(valor):
+    """Prepara un valor para guardarlo compartido: las estructuras mutables pasan a ser de solo lectura."""
+    if isinstance(valor, (bytearray, BytesIO)):
+        return bytes(valor.getvalue() if isinstance(valor, BytesIO) else valor)
+    if isinstance(valor, dict):
+        return MappingProxyType({k: congelar(v) for k, v in valor.items()})
+    if isinstance(valor, list):
+        return tuple(congelar(v) for v in valor)
+    if isinstance(valor, pd.DataFrame):
+        _solo_lectura(valor)
+    return valor
+
+
+def _solo_lectura(df):
+    """
+    Marca como de solo lectura los arrays de todas las columnas (también el de
+    geometrías, que comparte el índice espacial): una escritura en el original
+    o en una vista lanza ValueError en vez de cambiar los datos compartidos.
+    """
+    for bloque in df._mgr.blocks:
+        datos = getattr(bloque.values, "_data", bloque.values)  # GeometryArray guarda un ndarray
+        if isinstance(datos, np.ndarray):
+            datos.flags.writeable = False
+
+
+def vista(valor):
+    """
+    Lo que recibe cada llamador. Los (Geo)DataFrames se entregan como copia
+    superficial: no se copian datos ni el índice espacial. Añadir o sustituir
+    columnas solo cambia la copia; escribir en los valores guardados lanza
+    ValueError (arrays de solo lectura, ver congelar).
+    """
+    if isinstance(valor, pd.DataFrame):
+        return valor.copy(deep=False)
+    return valor
+
+
+# === TAMAÑO REAL EN MEMORIA DE CADA ENTRADA ===
+def tamano_en_memoria(valor):
+    """Estimación en bytes de la memoria que ocupa un valor cacheado."""
+    if isinstance(valor, (bytes, bytearray)):
+        return sys.getsizeof(valor)
+    if isinstance(valor, pd.DataFrame):
+        total = 0
+        for columna in valor.columns:
+            serie = valor[columna]
+            if str(serie.dtype) == "geometry":
+                total += _tamano_geometrias(serie)
+            else:
+                total += int(serie.memory_usage(index=False, deep=True))
+        return total + int(valor.index.memory_usage(deep=True))
+    if isinstance(valor, Mapping):
+        return sys.getsizeof(valor) + sum(
+            tamano_en_memoria(k) + tamano_en_memoria(v) for k, v in valor.items()
+        )
+    if isinstance(valor, (tuple, list)):
+        return sys.getsizeof(valor) + sum(tamano_en_memoria(v) for v in valor)
+    return sys.getsizeof(valor)
+
+
+def _tamano_geometrias(serie):
+    import shapely
+
+    geometrias = serie.values
+    # GEOS guarda 3 dobles por vértice; ~250 bytes de anillos/envolvente/objeto
+    # Python por geometría y ~110 por geometría en el STRtree (medido con RSS)
+    coordenadas = int(shapely.get_num_coordinates(geometrias).sum())
+    total = 24 * coordenadas + 250 * len(geometrias)
+    if getattr(geometrias, "_sindex", None) is not None:
+        total += 110 * len(geometrias)
+    return total
+
+
+# === ALMACÉN COMPARTIDO DE PROCESO CON PRESUPUESTO DE MEMORIA ===
+class Almacen:
+    """
+    Caché de proceso (como st.cache_resource) compartida por todas las sesiones,
+    sin serializar ni copiar en cada acceso:
+    - cada clave se carga una sola vez aunque la pidan varios hilos a la vez
+    - los resultados None (fallos) no se guardan, para reintentar en el próximo acceso
+    - ttl opcional en segundos, por almacén o por entrada
+    - revalidar=True (stale-while-revalidate): una entrada caducada se sigue
+      entregando mientras un hilo en segundo plano la recarga; si la recarga
+      falla se conserva la última copia buena y se reintenta más tarde
+    - presupuesto de memoria en bytes: al superarlo se expulsan las entradas
+      usadas hace más tiempo (LRU)
+    """
+
+    def __init__(self, max_bytes=None, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._datos = OrderedDict()  # clave -> (valor congelado, caduca, bytes); orden LRU
+        self._cargando = {}          # clave -> [Lock de la carga en curso, hilos que lo usan]
+        self._revalidando = {}       # clave -> instante del último intento de revalidar
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self.expulsiones = 0
+        self.revalidaciones = 0
+
+    @staticmethod
+    def _caducada(entrada):
+        return entrada[1] is not None and time.monotonic() >= entrada[1]
+
+    def _leer(self, clave, conservar_caducada=False):
+        """Entrada vigente (y la marca como recién usada) o None. Llamar con self._lock."""
+        entrada = self._datos.get(clave)
+        if entrada is None:
+            return None
+        if self._caducada(entrada) and not conservar_caducada:
+            self._quitar(clave)
+            return None
+        self._datos.move_to_end(clave)
+        return entrada
+
+    def _quitar(self, clave):
+        entrada = self._datos.pop(clave, None)
+        if entrada is not None:
+            self.bytes -= entrada[2]
+        self._revalidando.pop(clave, None)
+
+    def _guardar(self, clave, valor, ttl):
+        tamano = tamano_en_memoria(valor)
+        caduca = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._quitar(clave)
+            self._datos[clave] = (valor, caduca, tamano)
+            self.bytes += tamano
+            # Nunca se expulsa la entrada recién cargada, aunque por sí sola supere el presupuesto
+            while self.max_bytes is not None and self.bytes > self.max_bytes and len(self._datos) > 1:
+                antigua = next(iter(self._datos))
+                self._quitar(antigua)
+                self.expulsiones += 1
+
+    def _revalidar(self, clave, cargador, ttl):
+        """Lanza la recarga en segundo plano de una entrada caducada. Llamar con self._lock."""
+        ultimo = self._revalidando.get(clave)
+        if ultimo is not None and time.monotonic() - ultimo < REINTENTO_REVALIDAR:
+            return  # Ya en curso, o falló hace poco
+        self._revalidando[clave] = time.monotonic()
+        self.revalidaciones += 1
+
+        def recargar():
+            try:
+                valor = cargador()
+            except Exception:
+                valor = None
+            if valor is None:
+                return  # Se conserva la copia caducada; se reintentará tras REINTENTO_REVALIDAR
+            self._guardar(clave, congelar(valor), ttl)  # Sustitución atómica de la entrada
+            with self._lock:
+                self._revalidando.pop(clave, None)
+
+        threading.Thread(target=recargar, name=f"revalidar-{clave}", daemon=True).start()
+
+    def obtener(self, clave, cargador, ttl=None, revalidar=False):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            entrada = self._leer(clave, conservar_caducada=revalidar)
+            if entrada is not None:
+                self.aciertos += 1
+                if self._caducada(entrada):
+                    self._revalidar(clave, cargador, ttl)
+                return vista(entrada[0])
+            carga = self._cargando.setdefault(clave, [threading.Lock(), 0])
+            carga[1] += 1
+
+        try:
+            with carga[0]:
+                with self._lock:
+                    entrada = self._leer(clave, conservar_caducada=revalidar)
+                    if entrada is not None:
+                        self.aciertos += 1  # Otro hilo lo cargó mientras esperábamos
+                    else:
+                        self.fallos += 1
+                if entrada is not None:
+                    return vista(entrada[0])
+                valor = cargador()
+                if valor is None:
+                    return None
+                valor = congelar(valor)
+                self._guardar(clave, valor, ttl)
+        finally:
+            # El lock se retira cuando no queda ningún hilo esperándolo
+            with self._lock:
+                carga[1] -= 1
+                if not carga[1]:
+                    del self._cargando[clave]
+        return vista(valor)
+
+    def invalidar(self, clave=None):
+        with self._lock:
+            if clave is None:
+                self._datos.clear()
+                self._revalidando.clear()
+                self.bytes = 0
+            else:
+                self._quitar(clave)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "entradas": len(self._datos),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "expulsiones": self.expulsiones,
+                "revalidaciones": self.revalidaciones,
+            }
+
+    def __contains__(self, clave):
+        with self._lock:
+            return self._leer(clave) is not None
+
+    def __len__(self):
+        return len(self._datos)
+
+
+# Almacén del proceso: parcelas e índices de catastro y capas WFS comparten presupuesto
+cache = Almacen(max_bytes=int(CACHE_MB * 1024 * 1024))
@@ -0,0 +1,475 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from almacen import cache
+from capas import AFECTA, NO_AFECTA, ResultadoAfeccion, atributos, consultas_afecciones, descargar_capa, wfs_urls
+from capas_locales import capas_locales, convertir_capa_local, parquet_local
+from catastro import (
+    CATASTRO_DIR, _firma_origen, cargar_shapefile, construir_indice_masas, extensiones_municipios,
+    leer_geoparquet, shp_urls,
+)
+from instantaneas import MAX_EDAD, actualizar_instantanea, edad, ruta_actual, ruta_version
+
+# Atlas parcela x afección precalculado:
+# - <dir>/<municipio>.parquet: (masa, parcela, clave, elementos) de cada parcela afectada
+# - <dir>/<municipio>.json: versiones de catastro y de cada capa con que se calculó
+# - <dir>/capas/<clave>.parquet: atributos (sin geometría) de los elementos de cada capa
+ATLAS_DIR = os.environ.get(
+    "AFECCIONES_ATLAS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "atlas")
+)
+
+
+def _ruta_municipio(base_name):
+    return os.path.join(ATLAS_DIR, f"{base_name}.parquet")
+
+
+def _ruta_capa(clave):
+    return os.path.join(ATLAS_DIR, "capas", f"{clave}.parquet")
+
+
+def _leer_json(ruta):
+    try:
+        with open(ruta, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _escribir_json(ruta, datos):
+    with open(ruta + ".part", "w", encoding="utf-8") as f:
+        json.dump(datos, f, ensure_ascii=False, indent=1)
+    os.replace(ruta + ".part", ruta)
+
+
+# === FUENTE DE CADA CAPA: INSTANTÁNEA O COPIA LOCAL ===
+def fuente_capa(clave):
+    """(ruta GeoParquet de la capa completa, versión) con la que se calcula el atlas, o None."""
+    actual = ruta_actual(clave)
+    if actual is not None:
+        return actual
+    local = parquet_local(clave) if clave in capas_locales else None
+    if local is not None:
+        return local[0], "local-" + local[1][:12]
+    return None
+
+
+def preparar_capas(claves=None, descargar=descargar_capa, informar=print):
+    """
+    Asegura una fuente completa para cada capa (descargando la instantánea si no
+    la hay) y escribe sus atributos en el atlas. Devuelve {clave: (ruta, versión)}
+    de las capas disponibles.
+    """
+    fuentes = {}
+    os.makedirs(os.path.dirname(_ruta_capa("x")), exist_ok=True)
+    for clave in claves or wfs_urls:
+        if ruta_actual(clave) is None and descargar is not None:
+            try:
+                actualizar_instantanea(clave, wfs_urls[clave], descargar)
+            except Exception as e:
+                informar(f"{clave}: sin instantánea ({e})")
+        if fuente_capa(clave) is None and clave in capas_locales:
+            convertir_capa_local(clave)
+        fuente = fuente_capa(clave)
+        if fuente is None:
+            continue
+        ruta, version = fuente
+        meta = _leer_json(_ruta_capa(clave) + ".json")
+        if meta is None or meta.get("version") != version:
+            tabla = leer_geoparquet(ruta)
+            tabla = pd.DataFrame(tabla.drop(columns=tabla.geometry.name))
+            tabla.to_parquet(_ruta_capa(clave) + ".part", index=False)
+            os.replace(_ruta_capa(clave) + ".part", _ruta_capa(clave))
+            _escribir_json(_ruta_capa(clave) + ".json", {"version": version, "elementos": len(tabla)})
+        fuentes[clave] = fuente
+    return fuentes
+
+
+# === CÁLCULO POR MUNICIPIO (EN PROCESOS SEPARADOS) ===
+_capas_trabajador = {}
+
+
+def _iniciar_trabajador(fuentes):
+    """Cada proceso lee las capas una vez y construye sus índices espaciales."""
+    for clave, (ruta, version) in fuentes.items():
+        gdf = leer_geoparquet(ruta)
+        gdf.sindex
+        _capas_trabajador[clave] = (gdf, version)
+
+
+def parcelas_municipio(base_name):
+    """GeoDataFrame con una fila por (MASA, PARCELA): la misma que se elige en "Por parcela"."""
+    filas = [fila for parcelas in construir_indice_masas(base_name).values() for fila in parcelas.values()]
+    gdf = cargar_shapefile(base_name)
+    return gdf.iloc[sorted(filas)]
+
+
+def _cruzar_capa(geometrias, gdf, crs=None):
+    """
+    Elementos de la capa que intersecta cada geometría, con el mismo predicado
+    que la consulta en vivo (capas.intersectan). Devuelve (posiciones de las
+    geometrías afectadas, [array de elementos de cada una]).
+    """
+    if gdf.crs is not None and crs is not None and gdf.crs != crs:
+        gdf = gdf.to_crs(crs)
+    i_geom, i_elemento = gdf.sindex.query(geometrias, predicate="intersects")
+    if not len(i_geom):
+        return np.empty(0, dtype=int), []
+    orden = np.lexsort((i_elemento, i_geom))
+    i_geom, i_elemento = i_geom[orden], i_elemento[orden]
+    cortes = np.flatnonzero(np.diff(i_geom)) + 1
+    return i_geom[np.r_[0, cortes]], np.split(i_elemento.astype("int32"), cortes)
+
+
+def _escribir_municipio(base_name, tabla, capas, parcelas, segundos):
+    tabla = tabla.sort_values(["masa", "parcela", "clave"], ignore_index=True)
+    destino = _ruta_municipio(base_name)
+    tabla.to_parquet(destino + ".part", index=False, compression="zstd")
+    os.replace(destino + ".part", destino)
+    _escribir_json(os.path.splitext(destino)[0] + ".json", {
+        "municipio": base_name,
+        "catastro": _firma_origen(base_name),
+        "capas": capas,
+        "parcelas": parcelas,
+        "filas": len(tabla),
+        "fecha": time.time(),
+        "segundos": round(segundos, 3),
+    })
+
+
+_COLUMNAS_TABLA = {"masa": [], "parcela": [], "clave": [], "elementos": []}
+
+
+def calcular_municipio(base_name):
+    """Cruza las parcelas de un municipio con todas las capas y escribe su tabla. Devuelve (base, parcelas, segundos)."""
+    inicio = time.perf_counter()
+    parcelas = parcelas_municipio(base_name)
+    masas = parcelas["MASA"].astype(str).to_numpy()
+    numeros = parcelas["PARCELA"].astype(str).to_numpy()
+
+    partes = []
+    for clave, (gdf, _) in _capas_trabajador.items():
+        unicas, grupos = _cruzar_capa(parcelas.geometry.values, gdf, parcelas.crs)
+        if len(unicas):
+            partes.append(pd.DataFrame({
+                "masa": masas[unicas], "parcela": numeros[unicas], "clave": clave, "elementos": grupos,
+            }))
+
+    tabla = pd.concat(partes, ignore_index=True) if partes else pd.DataFrame(_COLUMNAS_TABLA)
+    segundos = time.perf_counter() - inicio
+    capas = {clave: version for clave, (_, version) in _capas_trabajador.items()}
+    _escribir_municipio(base_name, tabla, capas, len(parcelas), segundos)
+    return base_name, len(parcelas), segundos
+
+
+def construir_atlas(archivos_base=None, procesos=None, descargar=descargar_capa, informar=print):
+    """
+    Trabajo offline: calcula el atlas de los municipios indicados (por defecto
+    todos) repartiéndolos entre 'procesos' procesos. Devuelve
+    {"parcelas", "segundos", "parcelas_por_segundo", "errores"}.
+    """
+    inicio = time.perf_counter()
+    fuentes = preparar_capas(descargar=descargar, informar=informar)
+    archivos_base = list(archivos_base or shp_urls.values())
+    total, errores = 0, {}
+    with ProcessPoolExecutor(
+        max_workers=procesos, initializer=_iniciar_trabajador, initargs=(fuentes,)
+    ) as pool:
+        futuros = {pool.submit(calcular_municipio, base): base for base in archivos_base}
+        for futuro in as_completed(futuros):
+            base = futuros[futuro]
+            try:
+                _, parcelas, segundos = futuro.result()
+            except Exception as e:
+                errores[base] = str(e)
+                informar(f"{base}: error: {e}")
+                continue
+            total += parcelas
+            informar(f"{base}: {parcelas} parcelas en {segundos:.1f} s ({parcelas / max(segundos, 1e-9):.0f} parcelas/s)")
+
+    segundos = time.perf_counter() - inicio
+    resumen = {
+        "parcelas": total,
+        "segundos": round(segundos, 2),
+        "parcelas_por_segundo": round(total / segundos, 1) if segundos else None,
+        "errores": errores,
+    }
+    informar(f"Total: {total} parcelas en {segundos:.1f} s ({resumen['parcelas_por_segundo']} parcelas/s), "
+             f"{len(fuentes)} capas, {len(errores)} errores")
+    return resumen
+
+
+# === MANTENIMIENTO INCREMENTAL AL CAMBIAR UNA CAPA ===
+def huellas_elementos(gdf):
+    """Huella (uint64) de cada elemento a partir de su geometría (WKB) y sus atributos."""
+    datos = pd.DataFrame(gdf.drop(columns=gdf.geometry.name)).reset_index(drop=True)
+    datos["__wkb"] = shapely.to_wkb(np.asarray(gdf.geometry.values))
+    return pd.util.hash_pandas_object(datos, index=False).to_numpy()
+
+
+def comparar_versiones(huellas_anteriores, huellas_nuevas):
+    """
+    Empareja los elementos de dos versiones de una capa por su huella (los
+    repetidos, por orden de aparición). Devuelve (posición nueva de cada
+    elemento anterior o -1, posiciones nuevas añadidas, posiciones anteriores
+    eliminadas). Un elemento modificado cuenta como eliminado + añadido.
+    """
+    anteriores = pd.DataFrame({"h": huellas_anteriores, "anterior": np.arange(len(huellas_anteriores))})
+    nuevas = pd.DataFrame({"h": huellas_nuevas, "nueva": np.arange(len(huellas_nuevas))})
+    anteriores["n"] = anteriores.groupby("h").cumcount()
+    nuevas["n"] = nuevas.groupby("h").cumcount()
+    pares = anteriores.merge(nuevas, on=["h", "n"], how="outer", indicator=True)
+
+    ambas = pares[pares["_merge"] == "both"]
+    correspondencia = np.full(len(huellas_anteriores), -1, dtype="int64")
+    correspondencia[ambas["anterior"].astype("int64")] = ambas["nueva"].astype("int64")
+    anadidos = pares.loc[pares["_merge"] == "right_only", "nueva"].astype("int64").to_numpy()
+    eliminados = pares.loc[pares["_merge"] == "left_only", "anterior"].astype("int64").to_numpy()
+    return correspondencia, anadidos, eliminados
+
+
+def _estado(elementos):
+    return AFECTA if len(elementos) else NO_AFECTA
+
+
+def actualizar_capa_municipio(base_name, clave, nueva, version, cambio=None, extension=None):
+    """
+    Actualiza en el atlas de un municipio una sola capa a su nueva versión.
+    'cambio' = (correspondencia, cajas de los elementos cambiados, huellas
+    anteriores, huellas nuevas); con None se recalcula la capa en todas las parcelas.
+    Solo se vuelven a cruzar las parcelas cuya envolvente toca un elemento
+    añadido, eliminado o modificado; en el resto se renumeran los elementos.
+    Devuelve (parcelas reevaluadas, [cambios de estado]).
+    """
+    inicio = time.perf_counter()
+    meta = _leer_json(os.path.splitext(_ruta_municipio(base_name))[0] + ".json")
+    tabla = pd.read_parquet(_ruta_municipio(base_name))
+    propias = tabla["clave"] == clave
+    otras, anteriores = tabla[~propias], tabla[propias]
+    antes = {(m, p): e for m, p, e in zip(anteriores["masa"], anteriores["parcela"], anteriores["elementos"])}
+
+    # Sin elementos cambiados dentro del municipio no hace falta leer sus parcelas
+    cajas = None if cambio is None else cambio[1]
+    if cajas is not None and (not len(cajas) or extension is None or not shapely.intersects(
+        shapely.box(*extension), shapely.union_all(cajas)
+    )):
+        candidatas = None
+    else:
+        parcelas = parcelas_municipio(base_name)
+        geometrias = parcelas.geometry.values
+        if cajas is None:
+            posiciones = np.arange(len(parcelas))
+        else:
+            # Envolvente de cada parcela frente a las cajas de los elementos cambiados
+            posiciones = np.unique(shapely.STRtree(cajas).query(np.asarray(geometrias))[0])
+        candidatas = parcelas.iloc[posiciones]
+
+    filas = []
+    reevaluadas = set()
+    if candidatas is not None and len(candidatas):
+        masas = candidatas["MASA"].astype(str).to_numpy()
+        numeros = candidatas["PARCELA"].astype(str).to_numpy()
+        reevaluadas = set(zip(masas, numeros))
+        unicas, grupos = _cruzar_capa(candidatas.geometry.values, nueva, candidatas.crs)
+        filas.extend(zip(masas[unicas], numeros[unicas], grupos))
+    if cambio is not None:
+        correspondencia = cambio[0]
+        for (masa, parcela), elementos in antes.items():
+            if (masa, parcela) in reevaluadas:
+                continue
+            renumerados = correspondencia[np.asarray(elementos, dtype="int64")]
+            renumerados = np.sort(renumerados[renumerados >= 0]).astype("int32")
+            if len(renumerados):
+                filas.append((masa, parcela, renumerados))
+
+    despues = {(m, p): e for m, p, e in filas}
+    cambios = []
+    for masa, parcela in sorted(reevaluadas):
+        previos, nuevos = antes.get((masa, parcela), ()), despues.get((masa, parcela), ())
+        if cambio is not None:
+            iguales = sorted(cambio[2][np.asarray(previos, dtype="int64")]) == sorted(
+                cambio[3][np.asarray(nuevos, dtype="int64")]
+            )
+        else:
+            iguales = _estado(previos) == _estado(nuevos)
+        if not iguales:
+            cambios.append({
+                "municipio": base_name, "masa": masa, "parcela": parcela,
+                "antes": _estado(previos), "despues": _estado(nuevos),
+            })
+
+    propias = pd.DataFrame(
+        {"masa": [f[0] for f in filas], "parcela": [f[1] for f in filas], "clave": clave,
+         "elementos": [f[2] for f in filas]}
+    ) if filas else pd.DataFrame(_COLUMNAS_TABLA)
+    capas = dict(meta["capas"], **{clave: version})
+    _escribir_municipio(
+        base_name, pd.concat([otras, propias], ignore_index=True), capas, meta["parcelas"],
+        time.perf_counter() - inicio,
+    )
+    return len(reevaluadas), cambios
+
+
+def actualizar_atlas(claves=None, archivos_base=None, informar=print):
+    """
+    Lleva el atlas existente a la versión actual de cada capa sin recalcularlo
+    entero: compara elemento a elemento la versión con que se calculó cada
+    municipio (si la instantánea anterior se conserva) con la actual.
+    Escribe y devuelve un resumen por capa con las parcelas que cambian de estado.
+    """
+    archivos_base = [
+        base for base in (archivos_base or shp_urls.values())
+        if os.path.exists(os.path.splitext(_ruta_municipio(base))[0] + ".json")
+    ]
+    extensiones = extensiones_municipios(archivos_base, CATASTRO_DIR)
+    fuentes = preparar_capas(claves, descargar=None, informar=informar)
+    resumenes = {}
+    for clave, (ruta, version) in fuentes.items():
+        inicio = time.perf_counter()
+        pendientes = {}
+        for base in archivos_base:
+            meta = _leer_json(os.path.splitext(_ruta_municipio(base))[0] + ".json")
+            if meta["capas"].get(clave) != version:
+                pendientes.setdefault(meta["capas"].get(clave), []).append(base)
+        if not pendientes:
+            continue
+
+        nueva = leer_geoparquet(ruta)
+        nueva.sindex
+        huellas_nuevas = huellas_elementos(nueva)
+        resumen = {"clave": clave, "version": version, "anteriores": {}, "parcelas_reevaluadas": 0, "cambios": []}
+        for version_anterior, bases in pendientes.items():
+            ruta_anterior = ruta_version(clave, version_anterior) if version_anterior else None
+            cambio = None
+            if ruta_anterior is not None:
+                anterior = leer_geoparquet(ruta_anterior)
+                huellas_anteriores = huellas_elementos(anterior)
+                correspondencia, anadidos, eliminados = comparar_versiones(huellas_anteriores, huellas_nuevas)
+                cambiados = pd.concat([
+                    gpd.GeoSeries(anterior.geometry.values[eliminados], crs=anterior.crs),
+                    gpd.GeoSeries(nueva.geometry.values[anadidos], crs=nueva.crs).to_crs(anterior.crs),
+                ], ignore_index=True)
+                # Cajas en ETRS89 UTM 30N, el mismo sistema que las parcelas de CATASTRO/
+                if cambiados.crs is not None:
+                    cambiados = cambiados.to_crs("EPSG:25830")
+                cajas = shapely.box(*np.asarray(cambiados.bounds).T) if len(cambiados) else np.empty(0, dtype=object)
+                cambio = (correspondencia, cajas, huellas_anteriores, huellas_nuevas)
+                resumen["anteriores"][version_anterior] = {
+                    "anadidos": len(anadidos), "eliminados": len(eliminados), "municipios": len(bases),
+                }
+            else:
+                resumen["anteriores"][str(version_anterior)] = {"recalculo_completo": True, "municipios": len(bases)}
+
+            for base in bases:
+                reevaluadas, cambios = actualizar_capa_municipio(
+                    base, clave, nueva, version, cambio, extensiones.get(base)
+                )
+                resumen["parcelas_reevaluadas"] += reevaluadas
+                resumen["cambios"].extend(cambios)
+
+        resumen["segundos"] = round(time.perf_counter() - inicio, 2)
+        os.makedirs(os.path.join(ATLAS_DIR, "cambios"), exist_ok=True)
+        _escribir_json(os.path.join(ATLAS_DIR, "cambios", f"{clave}_{version}.json"), resumen)
+        informar(f"{clave}: {resumen['parcelas_reevaluadas']} parcelas reevaluadas, "
+                 f"{len(resumen['cambios'])} cambian de estado, {resumen['segundos']} s")
+        resumenes[clave] = resumen
+    return resumenes
+
+
+# === CONSULTA DEL ATLAS ===
+def _leer_tabla_municipio(base_name):
+    tabla = pd.read_parquet(_ruta_municipio(base_name))
+    indice = {}
+    for masa, parcela, clave, elementos in zip(tabla["masa"], tabla["parcela"], tabla["clave"], tabla["elementos"]):
+        indice.setdefault((masa, parcela), {})[clave] = tuple(int(i) for i in elementos)
+    return indice
+
+
+def _leer_atributos_capa(clave, version):
+    meta = _leer_json(_ruta_capa(clave) + ".json")
+    if meta is None or meta.get("version") != version:
+        return None
+    return pd.read_parquet(_ruta_capa(clave))
+
+
+def capas_vigentes(base_name):
+    """
+    Claves de las capas del atlas de un municipio que siguen al día (catastro y
+    capa sin cambios). Las calculadas con una instantánea más antigua que
+    instantaneas.MAX_EDAD no cuentan: esas capas se consultan en vivo.
+    """
+    meta = _leer_json(os.path.splitext(_ruta_municipio(base_name))[0] + ".json")
+    if meta is None or meta.get("catastro") != _firma_origen(base_name):
+        return meta, set()
+    vigentes = set()
+    for clave, version in meta["capas"].items():
+        fuente = fuente_capa(clave)
+        if fuente is None or fuente[1] != version:
+            continue
+        antiguedad = edad(clave)  # None con las copias de GeoJSON/
+        if antiguedad is not None and antiguedad > MAX_EDAD:
+            continue
+        vigentes.add(clave)
+    return meta, vigentes
+
+
+def resultados_atlas(base_name, masa, parcela, consultas=None):
+    """
+    {clave: ResultadoAfeccion} de una parcela leídos del atlas, solo para las
+    capas vigentes (las demás hay que consultarlas en vivo). {} si no hay atlas.
+    """
+    consultas = consultas_afecciones if consultas is None else consultas
+    try:
+        meta, vigentes = capas_vigentes(base_name)
+        if not vigentes:
+            return {}
+        indice = cache.obtener(
+            ("atlas", base_name, meta["fecha"]), lambda: _leer_tabla_municipio(base_name)
+        )
+        afectadas = indice.get((str(masa), str(parcela)), {})
+
+        resultados = {}
+        for clave, nombre, opciones in consultas:
+            if clave not in vigentes:
+                continue
+            base = dict(
+                clave=clave, nombre=nombre, campo_nombre=opciones.get('campo_nombre'),
+                campos_mup=tuple(opciones['campos_mup']) if opciones.get('campos_mup') else None,
+            )
+            if clave not in afectadas:
+                resultados[clave] = ResultadoAfeccion(estado=NO_AFECTA, **base)
+                continue
+            tabla = cache.obtener(
+                ("atlas_capa", clave, meta["capas"][clave]),
+                lambda: _leer_atributos_capa(clave, meta["capas"][clave]),
+            )
+            if tabla is None:
+                continue
+            filas = atributos(tabla, list(afectadas[clave]))
+            resultados[clave] = ResultadoAfeccion(estado=AFECTA, filas=filas, **base)
+        return resultados
+    except (OSError, ValueError, KeyError, ImportError):
+        return {}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Atlas parcela x afección precalculado")
+    parser.add_argument("municipios", nargs="*", help="Archivos base de CATASTRO/ (por defecto todos)")
+    parser.add_argument("--procesos", type=int, help="Procesos en paralelo (por defecto, nº de CPU)")
+    parser.add_argument("--sin-descarga", action="store_true",
+                        help="No descargar capas: usar solo instantáneas y copias locales")
+    parser.add_argument("--incremental", nargs="*", metavar="CAPA",
+                        help="Actualizar el atlas existente solo donde han cambiado estas capas (por defecto todas)")
+    args = parser.parse_args()
+    if args.incremental is not None:
+        actualizar_atlas(args.incremental or None, args.municipios or None)
+    else:
+        construir_atlas(args.municipios, args.procesos, descargar=None if args.sin_descarga else descargar_capa)
@@ -0,0 +1,344 @@
+import hashlib
+import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from io import BytesIO
+
+import geopandas as gpd
+import numpy as np
+
+from almacen import cache
+from capas_locales import cargar_capa_local
+from instantaneas import cargar_instantanea
+from red import session
+
+logger = logging.getLogger(__name__)
+
+WFS_BASE = "https://mapas-gis-inter.carm.es/geoserver"
+CAPAS_TTL = 604800  # 7 días
+# Tiempo máximo (s) para evaluar todas las capas de un informe; las pendientes quedan indeterminadas
+PLAZO_INFORME = float(os.environ.get("AFECCIONES_PLAZO_INFORME_S", "45"))
+
+
+def url_wfs(espacio, capa):
+    """URL GetFeature (GeoJSON) de una capa del geoserver de la CARM."""
+    return (
+        f"{WFS_BASE}/{espacio}/wfs?service=WFS&version=1.1.0&request=GetFeature"
+        f"&typeName={espacio}:{capa}&outputFormat=application/json"
+    )
+
+
+def url_con_filtro(url, geom, margen=1.0, rejilla=100.0, srs="EPSG:25830"):
+    """
+    Añade a una URL GetFeature un filtro BBOX con la envolvente de la geometría
+    consultada, para que el servidor devuelva solo los elementos candidatos (la
+    intersección exacta se sigue haciendo en el cliente).
+    La caja se amplía 'margen' metros y se redondea hacia fuera a una rejilla de
+    'rejilla' metros: consultas cercanas comparten URL y, por tanto, caché.
+    """
+    if geom is None or geom.is_empty:
+        return url
+    xmin, ymin, xmax, ymax = geom.bounds
+    xmin = math.floor((xmin - margen) / rejilla) * rejilla
+    ymin = math.floor((ymin - margen) / rejilla) * rejilla
+    xmax = math.ceil((xmax + margen) / rejilla) * rejilla
+    ymax = math.ceil((ymax + margen) / rejilla) * rejilla
+    return f"{url}&bbox={xmin:.0f},{ymin:.0f},{xmax:.0f},{ymax:.0f},{srs}"
+
+
+# === CAPAS WFS DE AFECCIONES ===
+wfs_urls = {
+    'flora': url_wfs("SIG_ZOR_PLANIGEST_CARM", "planes_recuperacion_flora2014"),
+    'garbancillo': url_wfs("SIG_ZOR_PLANIGEST_CARM", "plan_recuperacion_garbancillo"),
+    'malvasia': url_wfs("SIG_ZOR_PLANIGEST_CARM", "plan_recuperacion_malvasia"),
+    'fartet': url_wfs("SIG_ZOR_PLANIGEST_CARM", "plan_recuperacion_fartet"),
+    'nutria': url_wfs("SIG_ZOR_PLANIGEST_CARM", "plan_recuperacion_nutria"),
+    'perdicera': url_wfs("SIG_ZOR_PLANIGEST_CARM", "plan_recuperacion_perdicera"),
+    'tortuga': url_wfs("SIG_DES_BIOTA_CARM", "tortuga_distribucion_2001"),
+    'uso_suelo': url_wfs("SIT_USU_PLA_URB_CARM", "plu_ze_37_mun_uso_suelo"),
+    'esteparias': url_wfs("SIG_DES_BIOTA_CARM", "esteparias_ceea_2019_10x10"),
+    'enp': url_wfs("SIG_LUP_SITES_CARM", "ENP"),
+    'zepa': url_wfs("SIG_LUP_SITES_CARM", "ZEPA"),
+    'lic': url_wfs("SIG_LUP_SITES_CARM", "LIC-ZEC"),
+    'vp': url_wfs("PFO_ZOR_DMVP_CARM", "VP_CARM"),
+    'tm': url_wfs("MAP_UAD_DIVISION-ADMINISTRATIVA_CARM", "recintos_municipales_inspire_carm_etrs89"),
+    'mup': url_wfs("PFO_ZOR_DMVP_CARM", "MONTES"),
+}
+
+# Consultas del informe, en el orden en que se muestran: (clave, nombre de la afección, opciones)
+consultas_afecciones = [
+    ('flora', "FLORA", {'campo_nombre': "tipo"}),
+    ('garbancillo', "GARBANCILLO", {'campo_nombre': "tipo"}),
+    ('malvasia', "MALVASIA", {'campo_nombre': "clasificac"}),
+    ('fartet', "FARTET", {'campo_nombre': "clasificac"}),
+    ('nutria', "NUTRIA", {'campo_nombre': "tipo_de_ar"}),
+    ('perdicera', "ÁGUILA PERDICERA", {'campo_nombre': "zona"}),
+    ('tortuga', "TORTUGA MORA", {'campo_nombre': "cat_desc"}),
+    ('uso_suelo', "PLANEAMIENTO", {'campo_nombre': "Clasificacion"}),
+    ('esteparias', "ESTEPARIAS", {'campo_nombre': "nombre"}),
+    ('enp', "ENP", {'campo_nombre': "nombre"}),
+    ('zepa', "ZEPA", {'campo_nombre': "site_name"}),
+    ('lic', "LIC", {'campo_nombre': "site_name"}),
+    ('vp', "VP", {'campo_nombre': "vp_nb"}),
+    ('tm', "TM", {'campo_nombre': "nameunit"}),
+    ('mup', "MUP", {'campos_mup': ["id_monte:ID", "nombremont:Nombre", "municipio:Municipio", "propiedad:Propiedad"]}),
+]
+
+
+# === CAPAS PARSEADAS Y RESIDENTES CON ÍNDICE ESPACIAL ===
+def descargar_capa(url, timeout=30):
+    """Descarga el GeoJSON de una capa (lanza excepción si falla)."""
+    response = session.get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.content
+
+
+def descargar_capa_o_none(url, timeout=30):
+    """Como descargar_capa, pero registra el fallo y devuelve None (se usa la copia local si la hay)."""
+    try:
+        return descargar_capa(url, timeout=timeout)
+    except Exception as e:
+        logger.warning("Servicio no disponible: %s (%s)", url.split('/')[-1], e)
+        return None
+
+
+def parsear_capa(contenido):
+    gdf = gpd.read_file(BytesIO(contenido))
+    gdf.sindex  # El STRtree se construye una vez y se comparte con todas las consultas
+    return gdf
+
+
+def _huella_de_url(url, descargar):
+    contenido = descargar(url)
+    if contenido is None:
+        return None
+    huella = hashlib.sha1(contenido).hexdigest()
+    cache.obtener(("capa", huella), lambda: parsear_capa(contenido))
+    return huella
+
+
+def cargar_capa(url, descargar=descargar_capa):
+    """
+    GeoDataFrame de una capa WFS, parseado una sola vez y con su sindex.
+    - ("wfs", url) -> huella (sha1) del contenido descargado, con TTL de 7 días.
+      Pasado el TTL se sigue usando la huella anterior mientras se descarga la
+      nueva en segundo plano; si la descarga falla se conserva la anterior.
+    - ("capa", huella) -> GeoDataFrame: URLs con el mismo contenido lo comparten.
+      No caduca (el contenido de una huella no cambia); solo sale por LRU.
+    'descargar' devuelve los bytes o None si el servicio no está disponible.
+    """
+    for _ in range(2):
+        huella = cache.obtener(
+            ("wfs", url), lambda: _huella_de_url(url, descargar), ttl=CAPAS_TTL, revalidar=True
+        )
+        if huella is None:
+            return None
+        gdf = cache.obtener(("capa", huella), lambda: None)
+        if gdf is not None:
+            return gdf
+        # La capa parseada se expulsó por memoria: volver a descargarla
+        cache.invalidar(("wfs", url))
+    return None
+
+
+def posiciones_que_intersectan(gdf, geom):
+    """Posiciones de las filas que intersectan la geometría: consulta al sindex + predicado exacto, en orden."""
+    return np.sort(gdf.sindex.query(geom, predicate="intersects"))
+
+
+def intersectan(gdf, geom):
+    """Filas que intersectan la geometría, en el orden original."""
+    return gdf.iloc[posiciones_que_intersectan(gdf, geom)]
+
+
+def atributos(tabla, posiciones):
+    """
+    Atributos (sin geometría) de las filas indicadas como dicts, columna a columna:
+    evita construir un (Geo)DataFrame intermedio por consulta, que era lo más caro.
+    """
+    geometria = tabla.geometry.name if isinstance(tabla, gpd.GeoDataFrame) else None
+    campos = [campo for campo in tabla.columns if campo != geometria]
+    columnas = (tabla[campo].take(posiciones).tolist() for campo in campos)
+    return tuple(dict(zip(campos, valores)) for valores in zip(*columnas))
+
+
+# === RESULTADO TIPADO DE CADA AFECCIÓN ===
+AFECTA = "afecta"
+NO_AFECTA = "no_afecta"
+INDETERMINADO = "indeterminado"
+
+
+@dataclass(frozen=True)
+class ResultadoAfeccion:
+    """
+    Resultado de evaluar una capa: lo consumen tanto la lista en pantalla como
+    el PDF, sin volver a consultar la capa ni parsear textos.
+    - filas: atributos (sin geometría) de cada elemento que intersecta
+    - motivo: causa del estado indeterminado
+    - geometrias: las de esos elementos (ETRS89 UTM 30N), para dibujarlas en el
+      mapa sin volver a cargar la capa; vacía si el resultado viene del atlas
+    """
+    clave: str
+    nombre: str
+    estado: str
+    filas: tuple = ()
+    motivo: str = ""
+    campo_nombre: str = None
+    campos_mup: tuple = None
+    geometrias: tuple = field(default=(), repr=False, compare=False)
+
+    @property
+    def afecta(self):
+        return self.estado == AFECTA
+
+    @property
+    def texto(self):
+        """Texto de una línea (o bloque en MUP) que se muestra en pantalla."""
+        if self.estado == INDETERMINADO:
+            return f"Indeterminado: {self.nombre} ({self.motivo})"
+        if self.estado == NO_AFECTA:
+            return f"No afecta a {self.nombre}"
+
+        # --- MODO MUP: campos personalizados ---
+        if self.campos_mup:
+            info = []
+            for fila in self.filas:
+                info.append("\n".join(
+                    f"{etiqueta}: {fila.get(campo, 'Desconocido')}"
+                    for campo, etiqueta in self.etiquetas_mup()
+                ))
+            return f"Dentro de {self.nombre}:\n" + "\n\n".join(info)
+
+        # --- MODO NORMAL: solo nombres ---
+        nombres = []
+        for fila in self.filas:
+            valor = fila.get(self.campo_nombre)
+            if valor is not None and valor == valor and str(valor) not in nombres:  # valor == valor descarta NaN
+                nombres.append(str(valor))
+        return f"Dentro de {self.nombre}: {', '.join(nombres)}"
+
+    def etiquetas_mup(self):
+        """[(campo, etiqueta)] a partir de "campo:Etiqueta"."""
+        return [tuple(c.split(':', 1)) if ':' in c else (c, c) for c in self.campos_mup or ()]
+
+    def valores(self, campos, defecto="N/A"):
+        """Tuplas con los campos pedidos de cada fila (para las tablas del PDF)."""
+        return [tuple(fila.get(campo, defecto) for campo in campos) for fila in self.filas]
+
+
+def _respaldo(clave):
+    """Datos de una capa cuando el WFS falla: la instantánea aunque haya caducado o la copia de GeoJSON/."""
+    gdf = cargar_instantanea(clave, max_edad=None)
+    if gdf is not None:
+        logger.warning("Capa %s: WFS no disponible, se usa la instantánea caducada", clave)
+        return gdf
+    return cargar_capa_local(clave)  # Copia incluida en GeoJSON/ (ENP y MUP)
+
+
+def datos_capa(clave, geom, url, descargar=descargar_capa):
+    """
+    GeoDataFrame con los elementos de la capa para consultar 'geom': la
+    instantánea local si no es más antigua que instantaneas.MAX_EDAD; si no, el
+    WFS (filtrado por la envolvente, de la caché si ya se consultó) y, si el
+    servicio no está disponible (tanto si 'descargar' devuelve None como si
+    lanza), la instantánea caducada o la copia incluida en GeoJSON/ cuando las
+    hay. None si no hay datos; si la descarga o el parseo fallan y no hay
+    respaldo, lanza la excepción.
+    """
+    gdf = cargar_instantanea(clave)
+    if gdf is not None:
+        return gdf
+    try:
+        gdf = cargar_capa(url_con_filtro(url, geom), descargar=descargar)
+    except Exception as e:
+        respaldo = _respaldo(clave)
+        if respaldo is None:
+            raise
+        logger.warning("Capa %s: error en la descarga (%s), se usan datos locales", clave, e)
+        return respaldo
+    if gdf is None:
+        gdf = _respaldo(clave)
+    return gdf
+
+
+def evaluar_capa(clave, geom, url, nombre, campo_nombre=None, campos_mup=None, descargar=descargar_capa):
+    """Evalúa una capa (ver datos_capa) contra la geometría y devuelve su ResultadoAfeccion (nunca lanza)."""
+    base = dict(
+        clave=clave, nombre=nombre, campo_nombre=campo_nombre,
+        campos_mup=tuple(campos_mup) if campos_mup else None,
+    )
+    try:
+        gdf = datos_capa(clave, geom, url, descargar=descargar)
+    except Exception as e:
+        logger.warning("Capa %s: error al cargar los datos: %s", clave, e)
+        return ResultadoAfeccion(estado=INDETERMINADO, motivo="error de datos", **base)
+    if gdf is None:
+        logger.warning("Capa %s: servicio no disponible y sin copia local", clave)
+        return ResultadoAfeccion(estado=INDETERMINADO, motivo="servicio no disponible", **base)
+
+    try:
+        posiciones = posiciones_que_intersectan(gdf, geom)
+        if not len(posiciones):
+            return ResultadoAfeccion(estado=NO_AFECTA, **base)
+        if campo_nombre and campo_nombre not in gdf.columns:
+            raise KeyError(campo_nombre)
+        return ResultadoAfeccion(
+            estado=AFECTA, filas=atributos(gdf, posiciones),
+            geometrias=tuple(gdf.geometry.values[posiciones]), **base
+        )
+    except Exception as e:
+        logger.warning("Capa %s: error al cruzar la geometría: %s", clave, e)
+        return ResultadoAfeccion(estado=INDETERMINADO, motivo="error de datos", **base)
+
+
+# === EVALUACIÓN CONCURRENTE DE TODAS LAS CAPAS ===
+def evaluar_afecciones(geom, consultas=None, urls=None, descargar=descargar_capa,
+                       max_workers=None, inicializador=None, plazo=PLAZO_INFORME, pool=None):
+    """
+    Evalúa todas las capas en paralelo (comparten la sesión HTTP) y devuelve
+    {clave: ResultadoAfeccion} en el orden de 'consultas'. La latencia total es
+    la de la capa más lenta, con un máximo de 'plazo' segundos.
+    - max_workers: por defecto un hilo por capa
+    - inicializador: se ejecuta en cada hilo antes de consultar (p. ej. para
+      propagar el contexto de Streamlit)
+    - plazo: las capas que no han terminado a tiempo se devuelven como
+      indeterminadas; sus descargas siguen en segundo plano y llenan la caché
+      para el siguiente informe. None = sin límite
+    - pool: ThreadPoolExecutor compartido (p. ej. el de un servidor con muchas
+      consultas simultáneas) en vez de uno propio por llamada; max_workers e
+      inicializador se ignoran y las capas pendientes se cancelan sin cerrarlo
+    """
+    consultas = consultas_afecciones if consultas is None else consultas
+    urls = wfs_urls if urls is None else urls
+
+    propio = pool is None
+    if propio:
+        pool = ThreadPoolExecutor(
+            max_workers=max_workers or len(consultas), thread_name_prefix="wfs", initializer=inicializador
+        )
+    futuros = []
+    try:
+        for clave, nombre, opciones in consultas:
+            futuro = pool.submit(evaluar_capa, clave, geom, urls[clave], nombre, descargar=descargar, **opciones)
+            futuros.append((clave, nombre, opciones, futuro))
+        wait([futuro for *_, futuro in futuros], timeout=plazo)
+    finally:
+        if propio:
+            pool.shutdown(wait=False, cancel_futures=True)
+        else:
+            for *_, futuro in futuros:
+                futuro.cancel()
+
+    resultados = {}
+    for clave, nombre, opciones, futuro in futuros:
+        if futuro.done() and not futuro.cancelled():
+            resultados[clave] = futuro.result()
+        else:
+            resultados[clave] = ResultadoAfeccion(
+                clave=clave, nombre=nombre, estado=INDETERMINADO, motivo="tiempo agotado",
+                campo_nombre=opciones.get('campo_nombre'),
+                campos_mup=tuple(opciones['campos_mup']) if opciones.get('campos_mup') else None,
+            )
+    return resultados
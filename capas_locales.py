@@ -0,0 +1,189 @@
+"""
+Copias de capas WFS incluidas en el repositorio (GeoJSON/), para evaluar ENP y
+MUP cuando no hay instantánea y el WFS no responde. Cada fichero se lee por su
+formato real:
+- ENP.json: GeoJSON (FeatureCollection con "crs" EPSG:25830), leído con
+  geopandas tal cual
+- MUP.json: Esri JSON (FeatureSet con "rings" y "fields"), convertido con
+  esri_a_geometrias (orientación de anillos Esri) y _columnas_esri (fechas)
+En ambos casos los campos se pasan a minúsculas como en el WFS y el resultado
+se guarda una vez en GeoParquet (LOCALES_PARQUET_DIR).
+"""
+import hashlib
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from almacen import cache
+from catastro import leer_geoparquet
+
+# Copias de capas incluidas en el repositorio
+GEOJSON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "GeoJSON")
+# Caché columnar (GeoParquet) de esas capas ya convertidas
+LOCALES_PARQUET_DIR = os.environ.get(
+    "AFECCIONES_LOCALES_PARQUET_DIR", os.path.join(GEOJSON_DIR, "parquet")
+)
+
+# Capa WFS -> fichero local con los mismos datos
+capas_locales = {
+    'enp': "ENP.json",  # GeoJSON
+    'mup': "MUP.json",  # Esri JSON
+}
+
+
+# === ESRI JSON -> GEOMETRÍAS SHAPELY (VECTORIZADO) ===
+def _anillos_esri(features):
+    """Coordenadas de todos los anillos concatenadas, con el anillo y el elemento de cada uno."""
+    coordenadas, anillo_de_punto, elemento_de_anillo = [], [], []
+    n_anillos = 0
+    for i, feature in enumerate(features):
+        for anillo in (feature.get("geometry") or {}).get("rings", ()):
+            coordenadas.extend(anillo)
+            anillo_de_punto.append(np.full(len(anillo), n_anillos))
+            elemento_de_anillo.append(i)
+            n_anillos += 1
+    if not n_anillos:
+        return np.empty((0, 2)), np.empty(0, dtype=int), np.empty(0, dtype=int)
+    coordenadas = np.asarray(coordenadas, dtype=float)[:, :2]
+    return coordenadas, np.concatenate(anillo_de_punto), np.asarray(elemento_de_anillo)
+
+
+def esri_a_geometrias(features):
+    """
+    Polígonos Esri ("rings") -> array de geometrías shapely, uno por elemento.
+    En Esri los anillos exteriores van en sentido horario y los huecos en
+    antihorario, a continuación de su exterior. Los anillos se construyen todos
+    de una vez y se agrupan en polígonos y multipolígonos con índices.
+    """
+    coordenadas, anillo_de_punto, elemento_de_anillo = _anillos_esri(features)
+    geometrias = np.full(len(features), None, dtype=object)
+    if not len(elemento_de_anillo):
+        return geometrias
+
+    anillos = shapely.linearrings(coordenadas, indices=anillo_de_punto)
+    exterior = ~shapely.is_ccw(anillos)
+    # Un hueco al principio de un elemento (sin exterior previo) se trata como exterior
+    inicio_elemento = np.r_[True, elemento_de_anillo[1:] != elemento_de_anillo[:-1]]
+    exterior |= inicio_elemento
+    poligono_de_anillo = np.cumsum(exterior) - 1
+
+    poligonos = shapely.polygons(anillos, indices=poligono_de_anillo)
+    elemento_de_poligono = elemento_de_anillo[exterior]
+    multi = shapely.multipolygons(poligonos, indices=elemento_de_poligono)
+
+    # Los elementos de una sola parte quedan como Polygon, igual que en el WFS
+    simples = shapely.get_num_geometries(multi) == 1
+    multi[simples] = shapely.get_geometry(multi[simples], 0)
+    geometrias[np.unique(elemento_de_poligono)] = multi
+    return geometrias
+
+
+def _columnas_esri(datos):
+    """Atributos de un FeatureSet Esri como DataFrame, con las fechas convertidas."""
+    atributos = pd.DataFrame([f.get("attributes", {}) for f in datos["features"]])
+    for campo in datos.get("fields", ()):
+        if campo.get("type") == "esriFieldTypeDate" and campo["name"] in atributos:
+            atributos[campo["name"]] = pd.to_datetime(atributos[campo["name"]], unit="ms")
+    return atributos
+
+
+def _crs_esri(datos):
+    referencia = datos.get("spatialReference") or {}
+    wkid = referencia.get("latestWkid") or referencia.get("wkid")
+    return f"EPSG:{wkid}" if wkid else None
+
+
+def normalizar_campos(df):
+    """Nombres de campo como en el WFS de la CARM (en minúsculas: ID_MONTE -> id_monte)."""
+    return df.rename(columns={c: c.lower() for c in df.columns if c != df.geometry.name})
+
+
+def leer_capa_local(ruta):
+    """
+    GeoDataFrame con los campos del WFS de un fichero local: los Esri JSON
+    (FeatureSet, como MUP.json) se convierten aquí; el resto (GeoJSON, como
+    ENP.json) se lee con geopandas.
+    """
+    with open(ruta, encoding="utf-8") as f:
+        datos = json.load(f)
+    if "geometryType" in datos or "fieldAliases" in datos:
+        gdf = gpd.GeoDataFrame(
+            _columnas_esri(datos),
+            geometry=esri_a_geometrias(datos["features"]),
+            crs=_crs_esri(datos),
+        )
+    else:
+        gdf = gpd.read_file(ruta)
+    return normalizar_campos(gdf)
+
+
+# === CACHÉ COLUMNAR ===
+def _firma(ruta):
+    h = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for bloque in iter(lambda: f.read(1 << 20), b""):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+def ruta_parquet_local(clave):
+    return os.path.join(LOCALES_PARQUET_DIR, f"{clave}.parquet")
+
+
+def parquet_local(clave):
+    """(ruta del GeoParquet, firma del fichero de origen) de la copia local convertida, o None."""
+    destino = ruta_parquet_local(clave)
+    try:
+        with open(destino + ".json", encoding="utf-8") as f:
+            firma = json.load(f)["origen"]
+    except (OSError, ValueError, KeyError):
+        return None
+    return (destino, firma) if os.path.exists(destino) else None
+
+
+def convertir_capa_local(clave):
+    """Convierte el fichero local de una capa a GeoParquet (con su firma de origen al lado)."""
+    origen = os.path.join(GEOJSON_DIR, capas_locales[clave])
+    gdf = leer_capa_local(origen)
+    os.makedirs(LOCALES_PARQUET_DIR, exist_ok=True)
+    destino = ruta_parquet_local(clave)
+    gdf.to_parquet(destino + ".part", index=False, compression="snappy", geometry_encoding="WKB")
+    os.replace(destino + ".part", destino)
+    with open(destino + ".json", "w", encoding="utf-8") as f:
+        json.dump({"origen": _firma(origen), "filas": len(gdf)}, f)
+    return gdf
+
+
+def _leer_capa_local(clave):
+    origen = os.path.join(GEOJSON_DIR, capas_locales[clave])
+    destino = ruta_parquet_local(clave)
+    try:
+        with open(destino + ".json", encoding="utf-8") as f:
+            vigente = json.load(f).get("origen") == _firma(origen)
+        gdf = leer_geoparquet(destino) if vigente else None
+    except (OSError, ValueError, ImportError):
+        gdf = None
+    if gdf is None:
+        try:
+            gdf = convertir_capa_local(clave)
+        except (OSError, ImportError):
+            gdf = leer_capa_local(origen)  # Sin permisos de escritura o sin pyarrow
+    gdf.sindex
+    return gdf
+
+
+def cargar_capa_local(clave):
+    """GeoDataFrame (con sindex) de la copia local de una capa, o None si no la hay."""
+    if clave not in capas_locales or not os.path.exists(os.path.join(GEOJSON_DIR, capas_locales[clave])):
+        return None
+    return cache.obtener(("local", clave), lambda: _leer_capa_local(clave))
+
+
+if __name__ == "__main__":
+    for clave in capas_locales:
+        gdf = convertir_capa_local(clave)
+        print(f"{clave}: {len(gdf)} elementos -> {ruta_parquet_local(clave)}")
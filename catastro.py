@@ -0,0 +1,465 @@
+import hashlib
+import json
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import uuid
+
+import geopandas as gpd
+import shapely
+from shapely.geometry import Point
+
+from red import session
+
+CATASTRO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "CATASTRO")
+CATASTRO_URL = "https://raw.githubusercontent.com/iberiaforestal/AFECCIONES_CARM/main/CATASTRO/"
+MANIFIESTO = os.path.join(CATASTRO_DIR, "manifiesto.json")
+# Ficheros descargados de GitHub (municipios sin copia local); sobreviven al proceso
+CACHE_DIR = os.environ.get(
+    "AFECCIONES_CATASTRO_CACHE", os.path.join(tempfile.gettempdir(), "afecciones_catastro")
+)
+EXTENSIONES_SHP = [".shp", ".shx", ".dbf", ".prj", ".cpg"]
+# Caché columnar (GeoParquet) generada con "python catastro.py parquet"
+PARQUET_DIR = os.environ.get("AFECCIONES_PARQUET_DIR", os.path.join(CATASTRO_DIR, "parquet"))
+
+# Diccionario con los nombres de municipios y sus nombres base de archivo
+shp_urls = {
+    "ABANILLA": "ABANILLA",
+    "ABARAN": "ABARAN",
+    "AGUILAS": "AGUILAS",
+    "ALBUDEITE": "ALBUDEITE",
+    "ALCANTARILLA": "ALCANTARILLA",
+    "ALEDO": "ALEDO",
+    "ALGUAZAS": "ALGUAZAS",
+    "ALHAMA DE MURCIA": "ALHAMA_DE_MURCIA",
+    "ARCHENA": "ARCHENA",
+    "BENIEL": "BENIEL",
+    "BLANCA": "BLANCA",
+    "BULLAS": "BULLAS",
+    "CALASPARRA": "CALASPARRA",
+    "CAMPOS DEL RIO": "CAMPOS_DEL_RIO",
+    "CARAVACA DE LA CRUZ": "CARAVACA_DE_LA_CRUZ",
+    "CARTAGENA": "CARTAGENA",
+    "CEHEGIN": "CEHEGIN",
+    "CEUTI": "CEUTI",
+    "CIEZA": "CIEZA",
+    "FORTUNA": "FORTUNA",
+    "FUENTE ALAMO DE MURCIA": "FUENTE_ALAMO_DE_MURCIA",
+    "JUMILLA": "JUMILLA",
+    "LAS TORRES DE COTILLAS": "LAS_TORRES_DE_COTILLAS",
+    "LA UNION": "LA_UNION",
+    "LIBRILLA": "LIBRILLA",
+    "LORCA": "LORCA",
+    "LORQUI": "LORQUI",
+    "LOS ALCAZARES": "LOS_ALCAZARES",
+    "MAZARRON": "MAZARRON",
+    "MOLINA DE SEGURA": "MOLINA_DE_SEGURA",
+    "MORATALLA": "MORATALLA",
+    "MULA": "MULA",
+    "MURCIA": "MURCIA",
+    "OJOS": "OJOS",
+    "PLIEGO": "PLIEGO",
+    "PUERTO LUMBRERAS": "PUERTO_LUMBRERAS",
+    "RICOTE": "RICOTE",
+    "SANTOMERA": "SANTOMERA",
+    "SAN JAVIER": "SAN_JAVIER",
+    "SAN PEDRO DEL PINATAR": "SAN_PEDRO_DEL_PINATAR",
+    "TORRE PACHECO": "TORRE_PACHECO",
+    "TOTANA": "TOTANA",
+    "ULEA": "ULEA",
+    "VILLANUEVA DEL RIO SEGURA": "VILLANUEVA_DEL_RIO_SEGURA",
+    "YECLA": "YECLA",
+}
+
+
+# === MANIFIESTO DE INTEGRIDAD (tamaño + sha256 de cada fichero) ===
+def _sha256(ruta):
+    h = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for bloque in iter(lambda: f.read(1 << 20), b""):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+def generar_manifiesto(directorio=CATASTRO_DIR, destino=MANIFIESTO):
+    """Recalcula el manifiesto de los ficheros de CATASTRO/. Ejecutar tras actualizar los datos."""
+    manifiesto = {}
+    for nombre in sorted(os.listdir(directorio)):
+        if os.path.splitext(nombre)[1] in EXTENSIONES_SHP:
+            ruta = os.path.join(directorio, nombre)
+            manifiesto[nombre] = {"size": os.path.getsize(ruta), "sha256": _sha256(ruta)}
+    with open(destino, "w", encoding="utf-8") as f:
+        json.dump(manifiesto, f, indent=1, sort_keys=True)
+    return manifiesto
+
+
+_manifiesto = None
+
+
+def cargar_manifiesto():
+    global _manifiesto
+    if _manifiesto is None:
+        try:
+            with open(MANIFIESTO, encoding="utf-8") as f:
+                _manifiesto = json.load(f)
+        except (OSError, ValueError):
+            _manifiesto = {}
+    return _manifiesto
+
+
+# (dispositivo, inodo, tamaño, fecha, sha256 esperado) -> bool: cada versión de un fichero se hashea una vez
+_validados = {}
+
+
+def fichero_valido(ruta, nombre=None):
+    """
+    Comprueba tamaño y hash contra el manifiesto. Si el fichero no figura en el
+    manifiesto solo se exige que exista y no esté vacío. El resultado del hash
+    se recuerda mientras el fichero no cambie (mismo inodo, tamaño y fecha).
+    """
+    try:
+        estado = os.stat(ruta)
+    except OSError:
+        return False
+    if not stat.S_ISREG(estado.st_mode):
+        return False
+    esperado = cargar_manifiesto().get(nombre or os.path.basename(ruta))
+    if esperado is None:
+        return estado.st_size > 0
+    if estado.st_size != esperado["size"]:
+        return False
+    clave = (estado.st_dev, estado.st_ino, estado.st_size, estado.st_mtime_ns, esperado["sha256"])
+    if clave not in _validados:
+        _validados[clave] = _sha256(ruta) == esperado["sha256"]
+    return _validados[clave]
+
+
+# === CARGA DE SHAPEFILES: COPIA LOCAL CON RESPALDO REMOTO ===
+def _descargar_fichero(nombre, destino, timeout=100):
+    response = session.get(CATASTRO_URL + nombre, timeout=timeout)
+    response.raise_for_status()
+    # Escritura atómica: un proceso concurrente nunca ve un fichero a medias
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(destino), suffix=".part")
+    with os.fdopen(fd, "wb") as f:
+        f.write(response.content)
+    if not fichero_valido(tmp, nombre):
+        os.remove(tmp)
+        raise IOError(f"Fichero descargado corrupto: {nombre}")
+    os.replace(tmp, destino)
+
+
+def _enlace_al_dia(origen, destino):
+    """True si 'destino' es un enlace a 'origen' o una copia suya con el mismo tamaño y fecha."""
+    if os.path.islink(destino):
+        return os.path.realpath(destino) == os.path.realpath(origen)
+    try:
+        a, b = os.stat(origen), os.stat(destino)
+    except OSError:
+        return False
+    return a.st_size == b.st_size and a.st_mtime_ns == b.st_mtime_ns
+
+
+def _enlazar(origen, destino):
+    """Enlaza 'origen' en 'destino' (o lo copia conservando la fecha), sustituyendo atómicamente lo que hubiera."""
+    tmp = f"{destino}.{uuid.uuid4().hex}.part"
+    try:
+        os.symlink(origen, tmp)
+    except OSError:
+        shutil.copy2(origen, tmp)
+    os.replace(tmp, destino)
+
+
+def rutas_shapefile(base_name):
+    """
+    Devuelve la ruta del .shp listo para leer. Usa CATASTRO/ si todos los
+    ficheros están y son íntegros; si falta alguno, monta el juego en CACHE_DIR
+    enlazando los locales y descargando solo los que faltan. Lo que ya hubiera
+    en CACHE_DIR se rehace si no corresponde a la versión actual (enlace o copia
+    desfasada respecto a CATASTRO/, o descarga que no cuadra con el manifiesto),
+    para no mezclar versiones de .shp/.shx/.dbf.
+    """
+    locales = {ext: os.path.join(CATASTRO_DIR, base_name + ext) for ext in EXTENSIONES_SHP}
+    validos = {ext for ext, ruta in locales.items() if fichero_valido(ruta)}
+    if len(validos) == len(EXTENSIONES_SHP):
+        return locales[".shp"]
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    for ext in EXTENSIONES_SHP:
+        nombre = base_name + ext
+        destino = os.path.join(CACHE_DIR, nombre)
+        if ext in validos:
+            if not _enlace_al_dia(locales[ext], destino):
+                _enlazar(locales[ext], destino)
+        elif not fichero_valido(destino, nombre):
+            _descargar_fichero(nombre, destino)
+    return os.path.join(CACHE_DIR, base_name + ".shp")
+
+
+# === CACHÉ COLUMNAR GEOPARQUET ===
+def ruta_parquet(base_name):
+    return os.path.join(PARQUET_DIR, base_name + ".parquet")
+
+
+def _firma_origen(base_name):
+    """Tamaño y hash del .shp/.dbf de origen según el manifiesto (para detectar cachés obsoletas)."""
+    manifiesto = cargar_manifiesto()
+    return {ext: manifiesto.get(base_name + ext) for ext in (".shp", ".dbf")}
+
+
+def convertir_a_parquet(base_name):
+    """Convierte el shapefile de un municipio a GeoParquet (geometría WKB, MASA/PARCELA como texto)."""
+    gdf = gpd.read_file(rutas_shapefile(base_name))
+    for columna in ("MASA", "PARCELA"):
+        if columna in gdf.columns:
+            gdf[columna] = gdf[columna].astype("string")
+
+    os.makedirs(PARQUET_DIR, exist_ok=True)
+    destino = ruta_parquet(base_name)
+    tmp = destino + ".part"
+    # Grupos de filas pequeños: leer_parcela solo descomprime el grupo de la parcela pedida
+    gdf.to_parquet(
+        tmp, index=False, compression="snappy", geometry_encoding="WKB", row_group_size=4096
+    )
+    os.replace(tmp, destino)
+    with open(destino + ".json", "w", encoding="utf-8") as f:
+        json.dump({"origen": _firma_origen(base_name), "filas": len(gdf)}, f)
+    return destino
+
+
+def construir_parquet(archivos_base=None):
+    """Paso de construcción: convierte todos los municipios disponibles. Devuelve {base: error}."""
+    errores = {}
+    for base_name in archivos_base or shp_urls.values():
+        try:
+            convertir_a_parquet(base_name)
+        except Exception as e:
+            errores[base_name] = str(e)
+    return errores
+
+
+def parquet_valido(base_name):
+    ruta = ruta_parquet(base_name)
+    try:
+        with open(ruta + ".json", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return os.path.exists(ruta) and meta.get("origen") == _firma_origen(base_name)
+
+
+_crs_cache = {}
+
+
+def _crs_geoparquet(schema):
+    """CRS de la columna geometry según los metadatos 'geo' (cacheado: crearlo cuesta más que leer)."""
+    from pyproj import CRS
+
+    geo = json.loads(schema.metadata[b"geo"])
+    crs_json = geo["columns"]["geometry"].get("crs")
+    clave = json.dumps(crs_json, sort_keys=True)
+    if clave not in _crs_cache:
+        _crs_cache[clave] = CRS.from_user_input(crs_json) if crs_json else None
+    return _crs_cache[clave]
+
+
+def _tabla_a_gdf(tabla, schema):
+    """Tabla Arrow de un GeoParquet -> GeoDataFrame (WKB decodificado en bloque)."""
+    wkb = tabla.column("geometry").to_numpy(zero_copy_only=False)
+    atributos = tabla.drop(["geometry"]).to_pandas()
+    geometria = gpd.GeoSeries(
+        shapely.from_wkb(wkb), crs=_crs_geoparquet(schema), index=atributos.index
+    )
+    return gpd.GeoDataFrame(atributos, geometry=geometria)
+
+
+def leer_geoparquet(ruta, columnas=None):
+    """
+    Lee un GeoParquet escrito por geopandas (geometría WKB en "geometry").
+    - columnas=None: GeoDataFrame completo
+    - columnas sin "geometry": DataFrame de atributos, sin decodificar geometrías
+    Lanza ImportError si no está pyarrow.
+    """
+    import pyarrow.parquet as pq
+
+    tabla = pq.read_table(ruta, columns=columnas)
+    if "geometry" not in tabla.column_names:
+        return tabla.to_pandas()
+    return _tabla_a_gdf(tabla, tabla.schema)
+
+
+def leer_parquet(base_name, columnas=None):
+    """Lee la caché GeoParquet de un municipio, o None si no existe, está obsoleta o falta pyarrow."""
+    if not parquet_valido(base_name):
+        return None
+    try:
+        return leer_geoparquet(ruta_parquet(base_name), columnas)
+    except ImportError:
+        return None
+
+
+def cargar_shapefile(base_name):
+    """
+    Carga las parcelas de un municipio: caché GeoParquet si está al día y, si no,
+    el shapefile. Lanza excepción si no se puede obtener.
+    """
+    gdf = leer_parquet(base_name)
+    if gdf is not None:
+        return gdf
+    return gpd.read_file(rutas_shapefile(base_name))
+
+
+# === ÍNDICE DE ATRIBUTOS MASA -> PARCELA (SIN GEOMETRÍAS) ===
+def leer_atributos(base_name, columnas=("MASA", "PARCELA")):
+    """Lee solo columnas de atributos (GeoParquet o DBF), sin decodificar geometrías."""
+    columnas = list(columnas)
+    df = leer_parquet(base_name, columnas)
+    if df is not None:
+        return df
+    dbf = os.path.join(CATASTRO_DIR, base_name + ".dbf")
+    if not (fichero_valido(dbf) and fichero_valido(os.path.join(CATASTRO_DIR, base_name + ".cpg"))):
+        dbf = os.path.splitext(rutas_shapefile(base_name))[0] + ".dbf"
+    return gpd.read_file(dbf, columns=columnas, ignore_geometry=True)
+
+
+def construir_indice_masas(base_name):
+    """
+    Devuelve {masa: {parcela: fila}} con polígonos y parcelas ya ordenados.
+    'fila' es la posición del registro en el shapefile, para leer luego solo
+    la geometría de la parcela elegida con leer_parcela.
+    """
+    df = leer_atributos(base_name)
+    df["fila"] = range(len(df))
+    df = df.dropna(subset=["MASA", "PARCELA"]).sort_values(["MASA", "PARCELA", "fila"])
+    df = df.drop_duplicates(["MASA", "PARCELA"], keep="first")
+
+    indice = {}
+    for masa, parcela, fila in zip(df["MASA"], df["PARCELA"], df["fila"]):
+        indice.setdefault(masa, {})[parcela] = int(fila)
+    return indice
+
+
+def leer_parcela(base_name, fila):
+    """Lee un único registro (atributos + geometría) por su posición en el shapefile."""
+    if parquet_valido(base_name):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            pq = None
+        if pq is not None:
+            archivo = pq.ParquetFile(ruta_parquet(base_name))
+            inicio = 0
+            for grupo in range(archivo.num_row_groups):
+                n = archivo.metadata.row_group(grupo).num_rows
+                if fila < inicio + n:
+                    tabla = archivo.read_row_group(grupo).slice(fila - inicio, 1)
+                    return _tabla_a_gdf(tabla, archivo.schema_arrow)
+                inicio += n
+            raise IndexError(f"Fila {fila} fuera de rango en {base_name}")
+    return gpd.read_file(rutas_shapefile(base_name), skip_features=fila, max_features=1)
+
+
+# === EXTENSIÓN DE CADA MUNICIPIO DESDE LA CABECERA DEL SHAPEFILE ===
+def leer_extension_shp(ruta):
+    """
+    Lee la caja envolvente (xmin, ymin, xmax, ymax) de la cabecera de 100 bytes
+    de un .shp o .shx, sin decodificar ninguna geometría.
+    """
+    with open(ruta, "rb") as f:
+        cabecera = f.read(100)
+    if len(cabecera) < 100 or struct.unpack(">i", cabecera[:4])[0] != 9994:
+        raise ValueError(f"Cabecera de shapefile no válida: {ruta}")
+    return struct.unpack("<4d", cabecera[36:68])
+
+
+def extensiones_municipios(archivos_base, directorio=CATASTRO_DIR):
+    """
+    Devuelve {archivo_base: (xmin, ymin, xmax, ymax)} leyendo el .shp local o,
+    si no está, su .shx (misma cabecera). Los que no tienen ninguno se omiten.
+    """
+    extensiones = {}
+    for archivo_base in archivos_base:
+        for ext in (".shp", ".shx"):
+            ruta = os.path.join(directorio, archivo_base + ext)
+            if os.path.exists(ruta):
+                try:
+                    extensiones[archivo_base] = leer_extension_shp(ruta)
+                    break
+                except (OSError, ValueError):
+                    continue
+    return extensiones
+
+
+# === ÍNDICE ESPACIAL DE PARCELAS DE TODA LA REGIÓN ===
+class IndiceParcelas:
+    """
+    Índice espacial de dos niveles sobre todas las parcelas de la región:
+    - Primero se resuelven los municipios candidatos con las extensiones de las
+      cabeceras (sin abrir ninguna geometría)
+    - Solo esos municipios se piden al cargador y se consultan con su STRtree
+      (gdf.sindex): una consulta al árbol + un predicado exacto
+    El cargador debe devolver el GeoDataFrame con el sindex ya construido y
+    cachearlo (p. ej. en almacen.cache); el índice no guarda copias.
+    """
+
+    def __init__(self, cargador, municipios, extensiones=None):
+        self._cargador = cargador              # archivo_base -> GeoDataFrame | None
+        self._municipios = dict(municipios)    # municipio -> archivo_base (orden de búsqueda)
+        self._extensiones = extensiones if extensiones is not None else {}
+
+    def candidatos(self, x, y):
+        """Municipios cuya extensión contiene el punto (o cuya extensión se desconoce)."""
+        resultado = []
+        for municipio, archivo_base in self._municipios.items():
+            extension = self._extensiones.get(archivo_base)
+            if extension is None:
+                resultado.append(municipio)
+                continue
+            xmin, ymin, xmax, ymax = extension
+            if xmin <= x <= xmax and ymin <= y <= ymax:
+                resultado.append(municipio)
+        return resultado
+
+    def construir(self):
+        """Carga todos los municipios por adelantado (útil para procesos por lotes)."""
+        for archivo_base in self._municipios.values():
+            self._cargador(archivo_base)
+        return self
+
+    def buscar(self, x, y):
+        """
+        Devuelve (municipio, masa, parcela, parcela_gdf) de la parcela que
+        contiene el punto, o None si ninguna lo contiene.
+        """
+        punto = Point(x, y)
+        for municipio in self.candidatos(x, y):
+            gdf = self._cargador(self._municipios[municipio])
+            if gdf is None or gdf.empty:
+                continue
+            # "within" = el punto está dentro de la parcela (equivale a gdf.contains(punto))
+            filas = gdf.sindex.query(punto, predicate="within")
+            if len(filas) == 0:
+                continue
+            # Mismo orden que el recorrido original: primera fila del municipio
+            parcela_gdf = gdf.iloc[[filas.min()]]
+            masa = parcela_gdf["MASA"].iloc[0]
+            parcela = parcela_gdf["PARCELA"].iloc[0]
+            return municipio, masa, parcela, parcela_gdf
+        return None
+
+if __name__ == "__main__":
+    import sys
+
+    orden = sys.argv[1] if len(sys.argv) > 1 else "manifiesto"
+    if orden == "manifiesto":
+        # python catastro.py manifiesto -> regenera CATASTRO/manifiesto.json
+        print(f"{len(generar_manifiesto())} ficheros en {MANIFIESTO}")
+    elif orden == "parquet":
+        # python catastro.py parquet [BASE ...] -> genera la caché GeoParquet
+        errores = construir_parquet(sys.argv[2:] or None)
+        for base_name, error in errores.items():
+            print(f"{base_name}: {error}")
+        print(f"Caché GeoParquet en {PARQUET_DIR} ({len(errores)} errores)")
+    else:
+        sys.exit("Uso: python catastro.py [manifiesto | parquet [BASE ...]]")
@@ -0,0 +1,107 @@
+"""
+Transformaciones de coordenadas con transformadores PROJ cacheados (uno por par
+de sistemas para todo el proceso: desde pyproj 3.1 un Transformer se puede
+usar desde varios hilos) y vectorizadas con NumPy: un millar de puntos cuesta
+lo mismo que uno.
+
+Sistemas admitidos como entrada:
+- EPSG:25830 ETRS89 / UTM 30N (el de las capas y el catastro)
+- EPSG:23030 ED50 / UTM 30N (cartografía antigua)
+- EPSG:4326  WGS84 geográficas, en orden (lon, lat)
+"""
+import re
+from functools import lru_cache
+
+import numpy as np
+from pyproj import Transformer
+
+ETRS89_UTM30 = "EPSG:25830"
+ED50_UTM30 = "EPSG:23030"
+WGS84 = "EPSG:4326"
+
+CRS_ENTRADA = {
+    ETRS89_UTM30: "ETRS89 / UTM 30N",
+    ED50_UTM30: "ED50 / UTM 30N",
+    WGS84: "WGS84 (lon, lat)",
+}
+# Nombres habituales -> código EPSG
+_ALIAS_CRS = {"etrs89": ETRS89_UTM30, "ed50": ED50_UTM30, "wgs84": WGS84}
+
+# Rango válido en ETRS89 UTM 30N (xmin, ymin, xmax, ymax); cualquier entrada se comprueba ya convertida
+RANGO_UTM30 = (500000, 4000000, 800000, 4800000)
+
+
+# === SISTEMAS DE REFERENCIA Y TRANSFORMADORES ===
+def normalizar_crs(crs):
+    """
+    Código EPSG canónico de un sistema admitido: 25830, "25830", "EPSG:25830",
+    "urn:ogc:def:crs:EPSG::23030", "ed50", "wgs84"... Lanza ValueError si no se admite.
+    """
+    if crs is None:
+        return ETRS89_UTM30
+    texto = str(crs).strip().lower()
+    if texto in _ALIAS_CRS:
+        return _ALIAS_CRS[texto]
+    codigo = re.search(r"(\d{4,5})$", texto)
+    if codigo and f"EPSG:{codigo.group(1)}" in CRS_ENTRADA:
+        return f"EPSG:{codigo.group(1)}"
+    if texto.endswith("crs84"):  # urn:ogc:def:crs:OGC:1.3:CRS84 (GeoJSON), también lon/lat
+        return WGS84
+    admitidos = ", ".join(f"{codigo} ({nombre})" for codigo, nombre in CRS_ENTRADA.items())
+    raise ValueError(f"Sistema de coordenadas no admitido: {crs}. Admitidos: {admitidos}")
+
+
+@lru_cache(maxsize=None)
+def transformador(origen, destino):
+    """
+    Transformer (x, y siempre en orden lon/lat o este/norte) cacheado por
+    proceso: no se reconstruye en cada rerun de Streamlit ni en cada conexión
+    de la API, que usan hilos nuevos.
+    """
+    return Transformer.from_crs(origen, destino, always_xy=True)
+
+
+def transformar(x, y, origen, destino):
+    """Arrays (x, y) transformados de 'origen' a 'destino'; admite escalares, listas o arrays."""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if origen == destino:
+        return x, y
+    return transformador(origen, destino).transform(x, y)
+
+
+# === ENTRADA EN CUALQUIER SISTEMA -> ETRS89 UTM 30N ===
+def fuera_de_rango(x, y):
+    """Máscara de los puntos ETRS89 UTM 30N no finitos o fuera del rango esperado."""
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    xmin, ymin, xmax, ymax = RANGO_UTM30
+    with np.errstate(invalid="ignore"):
+        return ~((x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax))
+
+
+def a_etrs89(x, y, crs=ETRS89_UTM30, validar=True):
+    """
+    Arrays (x, y) en ETRS89 UTM 30N a partir de coordenadas en cualquier sistema
+    admitido. Con 'validar', lanza ValueError si algún punto queda fuera de rango.
+    """
+    x, y = transformar(x, y, normalizar_crs(crs), ETRS89_UTM30)
+    if validar:
+        fuera = fuera_de_rango(x, y)
+        if fuera.any():
+            raise ValueError(
+                "Coordenadas fuera del rango esperado para ETRS89 UTM Zona 30"
+                + (f" ({int(fuera.sum())} de {fuera.size} puntos)" if fuera.size > 1 else "")
+            )
+    return x, y
+
+
+def a_geograficas(x, y, crs=ETRS89_UTM30):
+    """Arrays (lon, lat) WGS84, validando el rango como a_etrs89."""
+    x, y = a_etrs89(x, y, crs)
+    return transformar(x, y, ETRS89_UTM30, WGS84)
+
+
+def utm_a_geograficas(x, y):
+    """(lon, lat) de un punto ETRS89 / UTM 30N. Lanza ValueError si no es válido o está fuera de rango."""
+    lon, lat = a_geograficas(float(x), float(y))
+    return float(lon), float(lat)
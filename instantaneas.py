@@ -0,0 +1,223 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from io import BytesIO
+
+import geopandas as gpd
+
+from almacen import cache
+from catastro import leer_geoparquet
+
+# Instantáneas locales de las capas WFS: <dir>/<clave>/<version>.parquet + .json
+INSTANTANEAS_DIR = os.environ.get(
+    "AFECCIONES_INSTANTANEAS_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "instantaneas"),
+)
+# Versiones que se conservan por capa (la actual y las anteriores)
+VERSIONES_CONSERVADAS = 3
+# Antigüedad máxima (segundos) para usar una instantánea en las consultas en lugar del WFS:
+# AFECCIONES_INSTANTANEAS_MAX_DIAS, o dos intervalos de refresco (AFECCIONES_INSTANTANEAS_CADA_H),
+# o 7 días (lo que dura una capa WFS en la caché). Más antigua solo se usa si el WFS falla
+_max_dias = os.environ.get("AFECCIONES_INSTANTANEAS_MAX_DIAS", "")
+_cada_h = os.environ.get("AFECCIONES_INSTANTANEAS_CADA_H", "")
+if _max_dias:
+    MAX_EDAD = float(_max_dias) * 86400
+elif _cada_h:
+    MAX_EDAD = 2 * float(_cada_h) * 3600
+else:
+    MAX_EDAD = 7 * 86400
+
+
+def _directorio(clave):
+    return os.path.join(INSTANTANEAS_DIR, clave)
+
+
+def _escribir_json(ruta, datos):
+    tmp = ruta + ".part"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(datos, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, ruta)
+
+
+# === METADATOS DE LA VERSIÓN ACTUAL ===
+def metadatos(clave):
+    """Metadatos de la versión actual de una capa, o None si no hay instantánea."""
+    try:
+        with open(os.path.join(_directorio(clave), "actual.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def edad(clave):
+    """Segundos desde la última descarga comprobada de la capa (None si no hay instantánea)."""
+    meta = metadatos(clave)
+    if meta is None:
+        return None
+    return time.time() - meta.get("comprobada", meta["descargada"])
+
+
+def ruta_actual(clave):
+    """(ruta del GeoParquet, versión) de la instantánea actual de una capa, o None."""
+    meta = metadatos(clave)
+    if meta is None:
+        return None
+    return os.path.join(_directorio(clave), meta["fichero"]), meta["version"]
+
+
+def ruta_version(clave, version):
+    """Ruta del GeoParquet de una versión concreta (actual o anterior) de una capa, o None si ya no se conserva."""
+    ruta = os.path.join(_directorio(clave), version + ".parquet")
+    return ruta if os.path.exists(ruta) else None
+
+
+# === DESCARGA Y VERSIONADO ===
+def actualizar_instantanea(clave, url, descargar):
+    """
+    Descarga la capa completa y, si su contenido ha cambiado, guarda una versión
+    nueva (GeoParquet + metadatos: fecha, nº de elementos, sha1) y la marca como
+    actual. Si no ha cambiado solo se actualiza la fecha de comprobación.
+    Devuelve los metadatos de la versión actual.
+    """
+    contenido = descargar(url)
+    if contenido is None:
+        raise IOError(f"Servicio no disponible: {clave}")
+    sha1 = hashlib.sha1(contenido).hexdigest()
+    ahora = time.time()
+    directorio = _directorio(clave)
+    os.makedirs(directorio, exist_ok=True)
+
+    meta = metadatos(clave)
+    if meta is not None and meta["sha1"] == sha1:
+        meta["comprobada"] = ahora
+        _escribir_json(os.path.join(directorio, "actual.json"), meta)
+        return meta
+
+    gdf = gpd.read_file(BytesIO(contenido))
+    version = datetime.fromtimestamp(ahora, timezone.utc).strftime("%Y%m%dT%H%M%SZ") + "_" + sha1[:8]
+    ruta = os.path.join(directorio, version + ".parquet")
+    gdf.to_parquet(ruta + ".part", index=False, compression="snappy", geometry_encoding="WKB")
+    os.replace(ruta + ".part", ruta)
+
+    meta = {
+        "clave": clave,
+        "url": url,
+        "version": version,
+        "fichero": os.path.basename(ruta),
+        "descargada": ahora,
+        "comprobada": ahora,
+        "elementos": len(gdf),
+        "sha1": sha1,
+        "bytes_origen": len(contenido),
+    }
+    _escribir_json(os.path.join(directorio, version + ".json"), meta)
+    _escribir_json(os.path.join(directorio, "actual.json"), meta)  # Cambio atómico de versión
+    _podar(clave)
+    return meta
+
+
+def _podar(clave):
+    versiones = sorted(glob.glob(os.path.join(_directorio(clave), "*.parquet")))
+    for ruta in versiones[:-VERSIONES_CONSERVADAS]:
+        for fichero in (ruta, ruta[: -len(".parquet")] + ".json"):
+            try:
+                os.remove(fichero)
+            except OSError:
+                pass
+
+
+def actualizar_instantaneas(urls, descargar, max_edad=None):
+    """
+    Actualiza las capas de {clave: url} cuya instantánea no existe o tiene más
+    de 'max_edad' segundos (todas si max_edad es None).
+    Devuelve {clave: metadatos | mensaje de error}.
+    """
+    resumen = {}
+    for clave, url in urls.items():
+        antiguedad = edad(clave)
+        if max_edad is not None and antiguedad is not None and antiguedad < max_edad:
+            resumen[clave] = metadatos(clave)
+            continue
+        try:
+            resumen[clave] = actualizar_instantanea(clave, url, descargar)
+        except Exception as e:
+            resumen[clave] = f"Error: {e}"
+    return resumen
+
+
+_programador = None
+
+
+def programar_actualizacion(urls, descargar, intervalo):
+    """
+    Arranca (una vez por proceso) un hilo en segundo plano que cada 'intervalo'
+    segundos actualiza las instantáneas con más de 'intervalo' segundos.
+    """
+    global _programador
+    if _programador is not None and _programador.is_alive():
+        return _programador
+
+    def bucle():
+        while True:
+            actualizar_instantaneas(urls, descargar, max_edad=intervalo)
+            time.sleep(intervalo)
+
+    _programador = threading.Thread(target=bucle, name="instantaneas", daemon=True)
+    _programador.start()
+    return _programador
+
+
+# === LECTURA PARA LAS CONSULTAS ===
+def _leer_version(clave, fichero):
+    gdf = leer_geoparquet(os.path.join(_directorio(clave), fichero))
+    gdf.sindex
+    return gdf
+
+
+def cargar_instantanea(clave, max_edad=MAX_EDAD):
+    """
+    GeoDataFrame (con sindex) de la versión actual de una capa, o None si no hay
+    instantánea o es más antigua que max_edad segundos (None = cualquier
+    antigüedad). Cada versión se lee una sola vez por proceso; al publicarse
+    una nueva, la clave de caché cambia sola.
+    """
+    meta = metadatos(clave)
+    if meta is None:
+        return None
+    if max_edad is not None and time.time() - meta.get("comprobada", meta["descargada"]) > max_edad:
+        return None
+    try:
+        return cache.obtener(
+            ("instantanea", clave, meta["version"]), lambda: _leer_version(clave, meta["fichero"])
+        )
+    except (OSError, ImportError, ValueError):
+        return None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from capas import descargar_capa, wfs_urls
+
+    parser = argparse.ArgumentParser(description="Instantáneas locales de las capas WFS de la CARM")
+    parser.add_argument("capas", nargs="*", help="Claves a actualizar (por defecto todas)")
+    parser.add_argument("--max-horas", type=float, help="Solo las más antiguas que estas horas")
+    parser.add_argument("--cada-horas", type=float, help="Repetir indefinidamente con este intervalo")
+    args = parser.parse_args()
+
+    urls = {clave: url for clave, url in wfs_urls.items() if not args.capas or clave in args.capas}
+    max_edad = args.max_horas * 3600 if args.max_horas else None
+    while True:
+        for clave, meta in actualizar_instantaneas(urls, descargar_capa, max_edad).items():
+            if isinstance(meta, dict):
+                print(f"{clave}: {meta['version']} ({meta['elementos']} elementos)")
+            else:
+                print(f"{clave}: {meta}")
+        if not args.cada_horas:
+            break
+        time.sleep(args.cada_horas * 3600)
+        max_edad = args.cada_horas * 3600
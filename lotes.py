@@ -0,0 +1,247 @@
+import csv
+import json
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from shapely.geometry import shape
+
+from afecciones import _sin_acentos, calentar_caches, evaluar, generar_informe, localizar_parcela, localizar_punto
+from capas import AFECTA, INDETERMINADO, wfs_urls
+from coordenadas import ETRS89_UTM30, WGS84, a_etrs89, normalizar_crs
+
+# Columnas del resumen (además del estado de cada capa)
+COLUMNAS_RESUMEN = [
+    "id", "estado", "municipio", "poligono", "parcela", "x", "y",
+    "afecciones", "indeterminadas", "pdf", "segundos", "error",
+]
+# Alias admitidos en la entrada -> nombre interno
+ALIAS = {
+    "x": "x", "coordenada_x": "x", "utm_x": "x",
+    "y": "y", "coordenada_y": "y", "utm_y": "y",
+    "crs": "crs", "epsg": "crs", "srs": "crs",
+    "municipio": "municipio",
+    "poligono": "poligono", "masa": "poligono",
+    "parcela": "parcela",
+    "id": "id", "referencia": "id",
+    "nombre": "nombre", "apellidos": "apellidos", "dni": "dni",
+    "direccion": "dirección", "telefono": "teléfono", "email": "email",
+    "objeto": "objeto de la solicitud",
+}
+
+
+# === LECTURA DE LA ENTRADA (CSV O GEOJSON) ===
+def _normalizar(fila, numero):
+    tarea = {}
+    for campo, valor in fila.items():
+        nombre = ALIAS.get(_sin_acentos(campo).replace(" ", "_")) if campo else None
+        if nombre and valor not in (None, ""):
+            tarea[nombre] = str(valor).strip() if nombre not in ("x", "y") else valor
+    tarea.setdefault("id", str(numero))
+    return tarea
+
+
+def _convertir_coordenadas(tareas):
+    """
+    Pasa a ETRS89 UTM 30N las coordenadas de las tareas que vienen en otro
+    sistema (columna crs), con una sola transformación vectorizada por sistema.
+    Las que no se pueden convertir se dejan como están y fallan al localizarlas.
+    """
+    grupos = {}
+    for tarea in tareas:
+        if "x" not in tarea or "y" not in tarea:
+            continue
+        try:
+            crs = normalizar_crs(tarea.get("crs"))
+            x, y = (float(str(tarea[c]).replace(",", ".")) for c in ("x", "y"))
+        except ValueError:
+            continue
+        grupos.setdefault(crs, []).append((tarea, x, y))
+    for crs, puntos in grupos.items():
+        x, y = a_etrs89([p[1] for p in puntos], [p[2] for p in puntos], crs, validar=False)
+        for (tarea, _, _), xi, yi in zip(puntos, x.tolist(), y.tolist()):
+            tarea.update(x=xi, y=yi, crs=ETRS89_UTM30)
+
+
+def _crs_geojson(datos):
+    """
+    Sistema declarado en un GeoJSON ("crs" de la especificación de 2008) o, si no
+    lo declara, WGS84 lon/lat, el único que admite el RFC 7946.
+    """
+    return ((datos.get("crs") or {}).get("properties") or {}).get("name") or WGS84
+
+
+def leer_entrada(ruta):
+    """
+    Lista de tareas a partir de un CSV (columnas x/y o municipio/poligono/parcela,
+    separador , o ;) o de un GeoJSON (puntos en WGS84 lon/lat salvo que declare
+    otro "crs", o propiedades municipio/poligono/parcela). Las coordenadas en
+    ED50 UTM 30N o WGS84 (columna crs) se convierten a ETRS89 UTM 30N.
+    Cada tarea lleva un 'id' único.
+    """
+    if os.path.splitext(ruta)[1].lower() in (".json", ".geojson"):
+        with open(ruta, encoding="utf-8") as f:
+            datos = json.load(f)
+        tareas = []
+        for numero, feature in enumerate(datos.get("features", []), start=1):
+            fila = dict(feature.get("properties") or {})
+            if feature.get("geometry"):
+                punto = shape(feature["geometry"]).representative_point()
+                fila.setdefault("x", punto.x)
+                fila.setdefault("y", punto.y)
+                fila.setdefault("crs", _crs_geojson(datos))
+            tareas.append(_normalizar(fila, numero))
+    else:
+        with open(ruta, encoding="utf-8-sig", newline="") as f:
+            muestra = f.read(4096)
+            f.seek(0)
+            dialecto = csv.Sniffer().sniff(muestra, delimiters=",;\t")
+            tareas = [_normalizar(fila, numero) for numero, fila in enumerate(csv.DictReader(f, dialect=dialecto), start=1)]
+
+    _convertir_coordenadas(tareas)
+    vistos = set()
+    for tarea in tareas:
+        if tarea["id"] in vistos:
+            raise ValueError(f"Identificador repetido en la entrada: {tarea['id']}")
+        vistos.add(tarea["id"])
+    return tareas
+
+
+# === LOCALIZACIÓN DE CADA TAREA ===
+def localizar(tarea):
+    """Localizacion de una tarea, igual que los dos modos de la app: parcela completa o punto."""
+    if "municipio" in tarea and "poligono" in tarea and "parcela" in tarea:
+        return localizar_parcela(tarea["municipio"], tarea["poligono"], tarea["parcela"])
+    if "x" not in tarea or "y" not in tarea:
+        raise ValueError("Faltan coordenadas (x, y) o municipio/poligono/parcela")
+    return localizar_punto(str(tarea["x"]).replace(",", "."), str(tarea["y"]).replace(",", "."), tarea.get("crs"))
+
+
+# === UN INFORME ===
+def _nombre_fichero(identificador):
+    return re.sub(r"[^\w.-]", "_", identificador) + ".pdf"
+
+
+def procesar_tarea(tarea, destino, con_mapa=True):
+    """Genera el PDF de una tarea y devuelve su fila del resumen (nunca lanza)."""
+    inicio = time.perf_counter()
+    fila = {"id": tarea["id"]}
+    try:
+        localizacion = localizar(tarea)
+        fila.update(
+            municipio=localizacion.municipio, poligono=localizacion.masa, parcela=localizacion.parcela,
+            x=round(localizacion.x, 2), y=round(localizacion.y, 2),
+        )
+        resultados = evaluar(localizacion)
+        ruta_pdf = os.path.join(destino, _nombre_fichero(tarea["id"]))
+        generar_informe(localizacion, ruta_pdf + ".part", tarea, resultados, con_mapa=con_mapa)
+        os.replace(ruta_pdf + ".part", ruta_pdf)
+
+        fila.update({clave: resultado.estado for clave, resultado in resultados.items()})
+        fila.update(
+            estado="ok", pdf=os.path.basename(ruta_pdf),
+            afecciones=sum(r.estado == AFECTA for r in resultados.values()),
+            indeterminadas=sum(r.estado == INDETERMINADO for r in resultados.values()),
+        )
+    except Exception as e:
+        fila.update(estado="error", error=str(e))
+    fila["segundos"] = round(time.perf_counter() - inicio, 3)
+    return fila
+
+
+# === LOTE COMPLETO: PROCESOS, PROGRESO Y REANUDACIÓN ===
+def _leer_resumen(ruta):
+    """{id: fila} del resumen; descarta las filas truncadas (proceso interrumpido a mitad de escritura)."""
+    try:
+        with open(ruta, encoding="utf-8", newline="") as f:
+            return {fila["id"]: fila for fila in csv.DictReader(f) if fila.get("id") is not None}
+    except OSError:
+        return {}
+
+
+def _terminar_linea(ruta):
+    """Si la última fila quedó truncada sin salto de línea, lo añade para que la siguiente empiece en su línea."""
+    try:
+        with open(ruta, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) not in (b"\n", b"\r"):
+                f.write(b"\r\n")
+    except FileNotFoundError:
+        pass
+
+
+def _escribir_resumen(ruta, filas, columnas):
+    with open(ruta + ".part", "w", encoding="utf-8", newline="") as f:
+        escritor = csv.DictWriter(f, fieldnames=columnas, extrasaction="ignore")
+        escritor.writeheader()
+        escritor.writerows(filas)
+    os.replace(ruta + ".part", ruta)
+
+
+def procesar_lote(entrada, destino, procesos=None, con_mapa=True, informar=print):
+    """
+    Genera un PDF por tarea en 'destino' y un resumen.csv con el estado de cada
+    una. Cada informe terminado se anota enseguida en el resumen: si el proceso
+    se interrumpe, al relanzarlo se saltan los que ya tienen PDF.
+    """
+    tareas = leer_entrada(entrada)
+    os.makedirs(destino, exist_ok=True)
+    ruta_resumen = os.path.join(destino, "resumen.csv")
+    columnas = COLUMNAS_RESUMEN + list(wfs_urls)
+
+    previas = _leer_resumen(ruta_resumen)
+    hechas = {
+        identificador: fila for identificador, fila in previas.items()
+        if fila.get("estado") == "ok" and fila.get("pdf") and os.path.isfile(os.path.join(destino, fila["pdf"]))
+    }
+    pendientes = [tarea for tarea in tareas if tarea["id"] not in hechas]
+    informar(f"{len(tareas)} tareas: {len(hechas)} ya hechas, {len(pendientes)} pendientes")
+
+    # Con fork los procesos heredan las capas y los índices ya cargados por el padre
+    calentar_caches()
+    metodos = multiprocessing.get_all_start_methods()
+    contexto = multiprocessing.get_context("fork" if "fork" in metodos else None)
+
+    resultados = dict(hechas)
+    inicio = time.perf_counter()
+    nuevo = not os.path.exists(ruta_resumen)
+    _terminar_linea(ruta_resumen)
+    with open(ruta_resumen, "a", encoding="utf-8", newline="") as f:
+        escritor = csv.DictWriter(f, fieldnames=columnas, extrasaction="ignore")
+        if nuevo:
+            escritor.writeheader()
+        with ProcessPoolExecutor(max_workers=procesos, mp_context=contexto) as pool:
+            futuros = [pool.submit(procesar_tarea, tarea, destino, con_mapa) for tarea in pendientes]
+            for hechas_ahora, futuro in enumerate(as_completed(futuros), start=1):
+                fila = futuro.result()
+                resultados[fila["id"]] = fila
+                escritor.writerow(fila)
+                f.flush()
+                ritmo = hechas_ahora / (time.perf_counter() - inicio)
+                restantes = (len(pendientes) - hechas_ahora) / ritmo if ritmo else 0
+                informar(f"[{hechas_ahora}/{len(pendientes)}] {fila['id']}: {fila['estado']}"
+                         f"{' (' + fila['error'] + ')' if fila.get('error') else ''}"
+                         f" - {ritmo:.1f} informes/s, quedan ~{restantes:.0f} s")
+
+    # Resumen final consolidado: una fila por tarea, en el orden de la entrada
+    _escribir_resumen(ruta_resumen, [resultados[t["id"]] for t in tareas if t["id"] in resultados], columnas)
+    errores = sum(1 for t in tareas if resultados.get(t["id"], {}).get("estado") != "ok")
+    informar(f"Terminado: {len(tareas) - errores} informes, {errores} errores -> {ruta_resumen}")
+    return ruta_resumen
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Informes de afecciones por lotes (CSV o GeoJSON -> PDFs)")
+    parser.add_argument("entrada", help="CSV o GeoJSON con coordenadas o municipio/poligono/parcela")
+    parser.add_argument("destino", help="Carpeta de salida (PDFs + resumen.csv)")
+    parser.add_argument("--procesos", type=int, help="Procesos en paralelo (por defecto, nº de CPU)")
+    parser.add_argument("--sin-mapa", action="store_true", help="No incluir el mapa de OpenStreetMap")
+    args = parser.parse_args()
+    procesar_lote(args.entrada, args.destino, args.procesos, con_mapa=not args.sin_mapa)
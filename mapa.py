@@ -0,0 +1,149 @@
+"""
+Capas vectoriales del mapa interactivo (parcela y elementos de las capas que
+afectan, los mismos de la evaluación) con tamaño acotado, para que el HTML no
+crezca con la precisión del catastro ni con el tamaño de los polígonos:
+1. Recorte de los elementos a un rectángulo alrededor de la consulta
+   (PIXELES_MARGEN píxeles al zoom inicial del mapa)
+2. Simplificación de cada geometría sin romper su topología (polígonos válidos,
+   sin elementos que desaparezcan), a la tolerancia de PIXELES_TOLERANCIA
+   píxeles a ese zoom
+3. Cuantización de las coordenadas lon/lat a los decimales que esa tolerancia
+   permite distinguir
+La parcela no se simplifica: solo se cuantiza, a la tolerancia inicial. Si el
+total supera el presupuesto de bytes, se duplica la tolerancia de las capas y
+se repite; en último caso se omiten las capas más pesadas (nunca la parcela).
+"""
+import logging
+import math
+import os
+
+import numpy as np
+import shapely
+
+from capas import AFECTA, posiciones_que_intersectan
+from capas_locales import cargar_capa_local
+from coordenadas import ETRS89_UTM30, WGS84, transformar
+from instantaneas import cargar_instantanea
+
+logger = logging.getLogger(__name__)
+
+MAX_BYTES_MAPA = int(float(os.environ.get("AFECCIONES_MAPA_MAX_KB", "300")) * 1024)
+ZOOM_MAPA = 16
+PIXELES_TOLERANCIA = 0.5  # Por debajo de medio píxel la simplificación no se aprecia
+PIXELES_MARGEN = 600      # Algo más de media pantalla alrededor de la consulta
+INTENTOS = 6
+PARCELA = "Parcela"
+
+
+def metros_por_pixel(lat, zoom=ZOOM_MAPA):
+    """Resolución de las teselas Web Mercator (256 px) a una latitud y zoom."""
+    return 156543.03392 * math.cos(math.radians(lat)) / 2 ** zoom
+
+
+def _decimales(tolerancia):
+    """Decimales de grado que conservan una tolerancia en metros (1e-5° ~ 1,1 m)."""
+    return int(min(7, max(3, math.ceil(-math.log10(tolerancia / 111320)))))
+
+
+# === GEOMETRÍAS QUE SE DIBUJAN ===
+def _geometrias_locales(clave, geom):
+    """
+    Geometrías de los elementos que intersectan, leídas de la instantánea o de la
+    copia de GeoJSON/ (las fuentes del atlas). Nunca consulta el WFS.
+    """
+    try:
+        gdf = cargar_instantanea(clave, max_edad=None)  # La versión con la que se calculó el atlas
+        if gdf is None:
+            gdf = cargar_capa_local(clave)
+    except Exception as e:
+        logger.warning("Capa %s: no se puede dibujar: %s", clave, e)
+        return None
+    if gdf is None:
+        return None
+    return gdf.geometry.values[posiciones_que_intersectan(gdf, geom)].to_numpy()
+
+
+def geometrias_afectadas(geom, resultados, margen):
+    """
+    {nombre: array de geometrías ETRS89 UTM 30N} de los elementos que afectan,
+    recortadas a la envolvente de la consulta ampliada 'margen' metros. Se usan
+    las geometrías que ya cargó la evaluación; las capas resueltas con el atlas
+    se leen de disco. Dibujar el mapa no hace ninguna petición de red.
+    """
+    xmin, ymin, xmax, ymax = geom.bounds
+    caja = (xmin - margen, ymin - margen, xmax + margen, ymax + margen)
+    capas = {}
+    for clave, resultado in resultados.items():
+        if resultado.estado != AFECTA:
+            continue
+        if resultado.geometrias:
+            geometrias = np.array(resultado.geometrias, dtype=object)
+        else:
+            geometrias = _geometrias_locales(clave, geom)
+        if geometrias is None or not len(geometrias):
+            continue
+        recortadas = shapely.clip_by_rect(geometrias, *caja)
+        recortadas = recortadas[~shapely.is_empty(recortadas)]
+        if len(recortadas):
+            capas[resultado.nombre] = recortadas
+    return capas
+
+
+# === SIMPLIFICACIÓN, CUANTIZACIÓN Y PRESUPUESTO ===
+def a_geojson(geometrias, tolerancia, decimales):
+    """
+    FeatureCollection (texto) de geometrías ETRS89 UTM 30N, simplificadas (si
+    'tolerancia' no es 0) y en lon/lat redondeadas.
+    """
+    simples = geometrias
+    if tolerancia:
+        # Douglas-Peucker es ~6 veces más rápido; las geometrías que deja inválidas
+        # (anillos cruzados) o vacías (polígonos pequeños, líneas estrechas) se
+        # simplifican preservando la topología, que nunca las hace desaparecer
+        simples = shapely.simplify(geometrias, tolerancia, preserve_topology=False)
+        rehacer = ~shapely.is_valid(simples) | (shapely.is_empty(simples) & ~shapely.is_empty(geometrias))
+        if rehacer.any():
+            simples[rehacer] = shapely.simplify(geometrias[rehacer], tolerancia, preserve_topology=True)
+    simples = simples[~shapely.is_empty(simples)]
+
+    def a_wgs84(coordenadas):
+        lon, lat = transformar(coordenadas[:, 0], coordenadas[:, 1], ETRS89_UTM30, WGS84)
+        return np.round(np.column_stack([lon, lat]), decimales)
+
+    geometrias_json = shapely.to_geojson(shapely.transform(simples, a_wgs84))
+    features = ",".join('{"type":"Feature","properties":{},"geometry":%s}' % g for g in geometrias_json)
+    return '{"type":"FeatureCollection","features":[%s]}' % features
+
+
+def superposiciones(geom, resultados, parcela=None, zoom=ZOOM_MAPA, max_bytes=MAX_BYTES_MAPA):
+    """
+    [(nombre, GeoJSON)] para el mapa: la parcela (si se pasa su geometría) y
+    las capas que afectan, con un total de como mucho 'max_bytes'.
+    """
+    centro = geom.centroid
+    lat = float(transformar(centro.x, centro.y, ETRS89_UTM30, WGS84)[1])
+    resolucion = metros_por_pixel(lat, zoom)
+
+    capas = geometrias_afectadas(geom, resultados, PIXELES_MARGEN * resolucion)
+
+    tolerancia = PIXELES_TOLERANCIA * resolucion
+    fijas = []
+    if parcela is not None:
+        fijas.append((PARCELA, a_geojson(np.array([parcela], dtype=object), 0, _decimales(tolerancia))))
+    for _ in range(INTENTOS):
+        salida = fijas + [(nombre, a_geojson(g, tolerancia, _decimales(tolerancia))) for nombre, g in capas.items()]
+        total = sum(len(texto) for _, texto in salida)
+        if total <= max_bytes:
+            return salida
+        tolerancia *= 2
+
+    # Aún por encima del presupuesto: se conservan la parcela y las capas más ligeras
+    incluidas, total = [], 0
+    for nombre, texto in sorted(salida, key=lambda capa: (capa[0] != PARCELA, len(capa[1]))):
+        if nombre == PARCELA or total + len(texto) <= max_bytes:
+            incluidas.append((nombre, texto))
+            total += len(texto)
+        else:
+            logger.warning("Capa %s omitida del mapa (%d bytes, presupuesto %d)", nombre, len(texto), max_bytes)
+    orden = [nombre for nombre, _ in salida]
+    return sorted(incluidas, key=lambda capa: orden.index(capa[0]))
@@ -0,0 +1,105 @@
+"""
+Mide el arranque en frío de la app: cada repetición es un proceso nuevo que
+importa Streamlit y ejecuta una vez el script (AppTest), como la primera visita
+a un contenedor recién levantado.
+
+    python medir_arranque.py [--script carm.py] [--repeticiones 5] [--importtime]
+
+- primer render: ejecución completa del script hasta el primer dibujado,
+  incluidas sus importaciones (sin contar la de Streamlit, que es fija)
+- módulos: paquetes pesados que el script ha dejado importados
+- --importtime: los paquetes de primer nivel más caros importados por el script
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+PESADOS = (
+    "folium", "branca", "geopandas", "pandas", "shapely", "pyproj", "pyogrio", "pyarrow",
+    "fpdf", "staticmap", "PIL", "docx", "requests",
+)
+
+# Se ejecuta en el proceso hijo: argv[1] = script
+_MEDICION = """
+import json, sys, time
+inicio = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+importado = time.perf_counter()
+antes = set(sys.modules)
+at = AppTest.from_file(sys.argv[1], default_timeout=300).run()
+fin = time.perf_counter()
+nuevos = set(sys.modules) - antes
+print(json.dumps({
+    "streamlit": importado - inicio, "primer_render": fin - importado,
+    "excepciones": [str(e.value)[:200] for e in at.exception],
+    "modulos": len(nuevos), "pesados": sorted({m.split(".")[0] for m in nuevos} & set(sys.argv[2].split(","))),
+}))
+"""
+
+
+def medir(script, repeticiones=5):
+    """Lista de mediciones (dict) de 'repeticiones' procesos nuevos."""
+    mediciones = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        salida = subprocess.run(
+            [sys.executable, "-c", _MEDICION, script, ",".join(PESADOS)],
+            cwd=RAIZ, capture_output=True, text=True, check=True,
+        )
+        medicion = json.loads(salida.stdout.strip().splitlines()[-1])
+        medicion["total"] = time.perf_counter() - inicio
+        mediciones.append(medicion)
+    return mediciones
+
+
+def importaciones_caras(script, n=15):
+    """[(ms acumulados, paquete)] de primer nivel importados al ejecutar el script (python -X importtime)."""
+    salida = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _MEDICION, script, ",".join(PESADOS)],
+        cwd=RAIZ, capture_output=True, text=True, check=True,
+    )
+    base = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "from streamlit.testing.v1 import AppTest"],
+        cwd=RAIZ, capture_output=True, text=True, check=True,
+    )
+
+    def paquetes(texto):
+        resultado = {}
+        for linea in texto.splitlines():
+            if not linea.startswith("import time:") or "|" not in linea:
+                continue
+            _, acumulado, nombre = linea.split("|")
+            if acumulado.strip().isdigit() and nombre.strip() and nombre[1:2] != " ":
+                resultado[nombre.strip()] = int(acumulado) / 1000
+        return resultado
+
+    ya_importados = paquetes(base.stderr)
+    propios = {nombre: ms for nombre, ms in paquetes(salida.stderr).items() if nombre not in ya_importados}
+    return sorted(((ms, nombre) for nombre, ms in propios.items()), reverse=True)[:n]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tiempo hasta el primer render de la app en un proceso nuevo")
+    parser.add_argument("--script", default="carm.py")
+    parser.add_argument("--repeticiones", type=int, default=5)
+    parser.add_argument("--importtime", action="store_true")
+    args = parser.parse_args()
+
+    mediciones = medir(args.script, args.repeticiones)
+    if mediciones[-1]["excepciones"]:
+        print("Excepciones en el script:", mediciones[-1]["excepciones"])
+    for campo in ("streamlit", "primer_render", "total"):
+        valores = [m[campo] for m in mediciones]
+        print(f"{campo:>14}: mediana {statistics.median(valores) * 1000:7.0f} ms"
+              f" (mín {min(valores) * 1000:.0f}, máx {max(valores) * 1000:.0f})")
+    print(f"{'módulos':>14}: {mediciones[-1]['modulos']} nuevos; pesados: {', '.join(mediciones[-1]['pesados']) or '-'}")
+
+    if args.importtime:
+        print("\nImportaciones de primer nivel más caras del script (ms acumulados):")
+        for ms, nombre in importaciones_caras(args.script):
+            print(f"{ms:9.1f}  {nombre}")
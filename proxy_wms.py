@@ -0,0 +1,345 @@
+"""
+Proxy local con caché en disco para las imágenes WMS del mapa interactivo: las
+teselas (GetMap) de Red Natura, Montes y Vías Pecuarias y sus leyendas
+(GetLegendGraphic). Una zona ya vista se sirve desde disco sin esperar al
+geoserver de la CARM.
+
+    GET /wms?<parámetros WMS>   GetMap o GetLegendGraphic de una capa de CAPAS_WMS
+    GET /salud                  estado de la caché
+
+- Clave: capa + parámetros de la petición (bbox, tamaño, sistema, formato...)
+- Caducidad: AFECCIONES_WMS_TTL_H (teselas) y AFECCIONES_WMS_TTL_LEYENDA_H
+  (leyendas); si el geoserver falla se sirve la copia caducada
+- Tamaño: AFECCIONES_WMS_CACHE_MB; al superarlo se borran las imágenes usadas
+  hace más tiempo
+
+    python proxy_wms.py [--host 127.0.0.1] [--puerto 8001]
+
+El mapa solo usa el proxy si se define AFECCIONES_WMS_PROXY_URL, la URL por la
+que el navegador llega a él (p. ej. publicado tras el mismo proxy inverso HTTPS
+que la app); si no, pide las imágenes directamente al geoserver. Con
+AFECCIONES_WMS_PROXY_PUERTO la app lo arranca en su propio proceso.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, quote, urlencode, urlparse
+
+logger = logging.getLogger(__name__)
+
+WMS_URL = "https://mapas-gis-inter.carm.es/geoserver/ows"
+# Capas que se dibujan en el mapa (nombre en el control de capas -> capa WMS); el proxy solo sirve estas
+CAPAS_WMS = {
+    "Red Natura 2000": "SIG_LUP_SITES_CARM:RN2000",
+    "Montes": "PFO_ZOR_DMVP_CARM:MONTES",
+    "Vias Pecuarias": "PFO_ZOR_DMVP_CARM:VP_CARM",
+}
+PETICIONES = {"getmap", "getlegendgraphic"}
+FORMATOS = {"image/png", "image/jpeg", "image/png8"}
+
+CACHE_DIR = os.environ.get("AFECCIONES_WMS_CACHE", os.path.join(tempfile.gettempdir(), "afecciones_wms"))
+CACHE_MB = float(os.environ.get("AFECCIONES_WMS_CACHE_MB", "200"))
+TTL_TESELAS = float(os.environ.get("AFECCIONES_WMS_TTL_H", "168")) * 3600
+TTL_LEYENDAS = float(os.environ.get("AFECCIONES_WMS_TTL_LEYENDA_H", "720")) * 3600
+
+HOST = os.environ.get("AFECCIONES_WMS_PROXY_HOST", "127.0.0.1")
+PUERTO = int(os.environ.get("AFECCIONES_WMS_PROXY_PUERTO") or "8001")
+# URL pública por la que el navegador del usuario llega al proxy (no se deduce de HOST/PUERTO:
+# 127.0.0.1 sería la máquina del usuario, y una página HTTPS bloquea teselas http://)
+URL_PROXY = os.environ.get("AFECCIONES_WMS_PROXY_URL") or None
+
+
+class ErrorPeticion(Exception):
+    """Petición que el proxy no reenvía (código HTTP y mensaje para el cliente)."""
+
+    def __init__(self, codigo, mensaje):
+        super().__init__(mensaje)
+        self.codigo = codigo
+
+
+# === URLS PARA EL MAPA ===
+def url_wms():
+    """URL base para los WmsTileLayer: el proxy si está configurado, si no el geoserver."""
+    return f"{URL_PROXY.rstrip('/')}/wms?" if URL_PROXY else f"{WMS_URL}?SERVICE=WMS&?"
+
+
+def url_leyenda(capa, ancho=20, alto=20):
+    """URL de la imagen de leyenda (GetLegendGraphic) de una capa."""
+    base = f"{URL_PROXY.rstrip('/')}/wms" if URL_PROXY else WMS_URL
+    return (f"{base}?service=WMS&version=1.3.0&request=GetLegendGraphic&format=image%2Fpng"
+            f"&width={ancho}&height={alto}&layer={quote(capa)}")
+
+
+# === CACHÉ EN DISCO ===
+class CacheDisco:
+    """
+    Imágenes en 'directorio'/<capa>/<sha1 de los parámetros>, con la hora de
+    descarga aparte en <imagen>.t (caducidad). La fecha de modificación de la
+    imagen es la de su último uso (expulsión). Escrituras atómicas (.part +
+    os.replace).
+    """
+
+    def __init__(self, directorio=CACHE_DIR, max_bytes=int(CACHE_MB * 1024 * 1024)):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # ruta -> [Lock, peticiones que lo usan]: una sola descarga por imagen aunque la pidan
+        # varios; se retira cuando no queda ninguna esperando
+        self._descargando = {}
+        self.aciertos = self.fallos = self.caducadas = self.expulsiones = 0
+        os.makedirs(directorio, exist_ok=True)
+        self.bytes = sum(tamano for _, tamano, _ in self._ficheros())
+
+    def _ficheros(self):
+        """[(ruta, tamaño, último uso)] de las imágenes guardadas."""
+        ficheros = []
+        for raiz, _, nombres in os.walk(self.directorio):
+            for nombre in nombres:
+                if nombre.endswith((".part", ".t")):
+                    continue
+                ruta = os.path.join(raiz, nombre)
+                try:
+                    estado = os.stat(ruta)
+                except FileNotFoundError:
+                    continue
+                ficheros.append((ruta, estado.st_size, estado.st_mtime))
+        return ficheros
+
+    def ruta(self, capa, parametros):
+        huella = hashlib.sha1(urlencode(sorted(parametros.items())).encode("utf-8")).hexdigest()
+        return os.path.join(self.directorio, capa.replace(":", "_"), huella)
+
+    @staticmethod
+    def _leer(ruta):
+        """(contenido, segundos desde la descarga) o (None, None) si no está."""
+        try:
+            with open(ruta, "rb") as f:
+                contenido = f.read()
+            with open(ruta + ".t") as f:
+                descargado = float(f.read())
+        except (FileNotFoundError, ValueError):
+            return None, None
+        try:
+            os.utime(ruta)  # Último uso, para la expulsión
+        except FileNotFoundError:
+            pass
+        return contenido, time.time() - descargado
+
+    def _guardar(self, ruta, contenido):
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        anterior = os.path.getsize(ruta) if os.path.exists(ruta) else 0
+        for destino, datos in ((ruta, contenido), (ruta + ".t", str(time.time()).encode())):
+            with open(destino + ".part", "wb") as f:
+                f.write(datos)
+            os.replace(destino + ".part", destino)
+        with self._lock:
+            self.bytes += len(contenido) - anterior
+            exceso = self.bytes > self.max_bytes
+        if exceso:
+            self._expulsar()
+
+    def _expulsar(self):
+        """Borra las imágenes usadas hace más tiempo hasta quedar en el 90 % del máximo."""
+        imagenes = sorted(self._ficheros(), key=lambda fichero: fichero[2])
+        with self._lock:
+            self.bytes = sum(tamano for _, tamano, _ in imagenes)
+            for ruta, tamano, _ in imagenes:
+                if self.bytes <= self.max_bytes * 0.9:
+                    break
+                for fichero in (ruta, ruta + ".t"):
+                    try:
+                        os.remove(fichero)
+                    except FileNotFoundError:
+                        pass
+                self.bytes -= tamano
+                self.expulsiones += 1
+
+    def obtener(self, ruta, ttl, cargador):
+        """
+        (contenido, estado) con estado "acierto", "fallo" (descargada ahora) o
+        "caducada" (el cargador falló y se sirve la copia anterior). Si falla
+        y no hay copia, propaga la excepción del cargador.
+        """
+        contenido, edad = self._leer(ruta)
+        if contenido is not None and edad < ttl:
+            self.aciertos += 1
+            return contenido, "acierto"
+
+        with self._lock:
+            descarga = self._descargando.setdefault(ruta, [threading.Lock(), 0])
+            descarga[1] += 1
+        try:
+            with descarga[0]:
+                # Otra petición ha podido descargarla mientras se esperaba
+                contenido, edad = self._leer(ruta)
+                if contenido is not None and edad < ttl:
+                    self.aciertos += 1
+                    return contenido, "acierto"
+                try:
+                    nuevo = cargador()
+                except Exception:
+                    if contenido is None:
+                        raise
+                    self.caducadas += 1
+                    logger.warning("Geoserver no disponible: se sirve la copia caducada de %s", ruta)
+                    return contenido, "caducada"
+                self._guardar(ruta, nuevo)
+                self.fallos += 1
+                return nuevo, "fallo"
+        finally:
+            with self._lock:
+                descarga[1] -= 1
+                if descarga[1] == 0:
+                    del self._descargando[ruta]
+
+    def estadisticas(self):
+        return {
+            "aciertos": self.aciertos, "fallos": self.fallos, "caducadas": self.caducadas,
+            "expulsiones": self.expulsiones, "bytes": self.bytes, "max_bytes": self.max_bytes,
+        }
+
+
+# === PETICIONES WMS ===
+def validar(parametros):
+    """
+    (capa, parámetros normalizados, tiempo de vida) de una petición admitida.
+    Solo se reenvían GetMap/GetLegendGraphic de las capas del mapa, para que el
+    proxy no sirva de pasarela abierta al geoserver.
+    """
+    parametros = {clave.lower(): valor for clave, valor in parametros.items()}
+    peticion = parametros.get("request", "").lower()
+    if peticion not in PETICIONES:
+        raise ErrorPeticion(400, f"Petición WMS no admitida: {parametros.get('request')}")
+    capa = parametros.get("layers") if peticion == "getmap" else parametros.get("layer")
+    if capa not in CAPAS_WMS.values():
+        raise ErrorPeticion(403, f"Capa no servida por el proxy: {capa}")
+    if parametros.get("format", "image/png").lower() not in FORMATOS:
+        raise ErrorPeticion(400, f"Formato no admitido: {parametros.get('format')}")
+    parametros["service"] = "WMS"
+    return capa, parametros, TTL_TESELAS if peticion == "getmap" else TTL_LEYENDAS
+
+
+def descargar_imagen(parametros, timeout=30):
+    """Bytes de la imagen del geoserver; lanza si falla o si responde con un error WMS (XML)."""
+    from red import session  # Sesión con reintentos y cortocircuito por servidor
+
+    response = session.get(WMS_URL, params=parametros, timeout=timeout)
+    response.raise_for_status()
+    tipo = response.headers.get("Content-Type", "")
+    if not tipo.startswith("image/"):
+        raise ValueError(f"Respuesta del geoserver sin imagen ({tipo}): {response.text[:200]}")
+    return response.content
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def cache_disco():
+    """Caché de disco del proceso (se crea al primer uso)."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = CacheDisco()
+        return _cache
+
+
+def imagen(parametros):
+    """(contenido, tipo, tiempo de vida, estado de la caché) de una petición WMS."""
+    capa, parametros, ttl = validar(parametros)
+    cache = cache_disco()
+    try:
+        contenido, estado = cache.obtener(cache.ruta(capa, parametros), ttl, lambda: descargar_imagen(parametros))
+    except Exception as e:
+        raise ErrorPeticion(502, f"Geoserver no disponible: {e}")
+    return contenido, parametros.get("format", "image/png"), ttl, estado
+
+
+# === SERVIDOR ===
+class ManejadorWMS(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # El navegador pide muchas teselas por la misma conexión
+
+    def _responder(self, codigo, contenido, tipo, cabeceras=()):
+        self.send_response(codigo)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(contenido)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        for nombre, valor in cabeceras:
+            self.send_header(nombre, valor)
+        self.end_headers()
+        self.wfile.write(contenido)
+
+    def do_GET(self):
+        inicio = time.perf_counter()
+        url = urlparse(self.path)
+        estado = "-"
+        try:
+            if url.path.rstrip("/") == "/wms":
+                contenido, tipo, ttl, estado = imagen(dict(parse_qsl(url.query)))
+                # El navegador también la guarda: la misma tesela no vuelve a pedirse en la sesión.
+                # Una copia caducada no: se vuelve a pedir en cuanto el geoserver responda
+                cache_control = "no-cache" if estado == "caducada" else f"public, max-age={int(ttl)}"
+                self._responder(200, contenido, tipo, [("Cache-Control", cache_control), ("X-Cache", estado)])
+            elif url.path.rstrip("/") == "/salud":
+                import json
+
+                cuerpo = json.dumps({"estado": "ok", "cache": cache_disco().estadisticas()})
+                self._responder(200, cuerpo.encode("utf-8"), "application/json; charset=utf-8")
+            else:
+                raise ErrorPeticion(404, f"Ruta desconocida: {url.path}")
+            codigo = 200
+        except ErrorPeticion as e:
+            codigo = e.codigo
+            self._responder(codigo, str(e).encode("utf-8"), "text/plain; charset=utf-8")
+        except Exception as e:
+            logger.exception("Error en %s", self.path)
+            codigo = 500
+            self._responder(codigo, str(e).encode("utf-8"), "text/plain; charset=utf-8")
+        logger.info("%s %s %d %s %.1f ms", self.command, self.path, codigo, estado,
+                    (time.perf_counter() - inicio) * 1000)
+
+    def log_message(self, formato, *args):
+        pass  # Cada petición ya se registra con logging en do_GET
+
+
+def crear_servidor(host=HOST, puerto=PUERTO):
+    """Servidor (un hilo por conexión) listo para serve_forever()."""
+    servidor = ThreadingHTTPServer((host, puerto), ManejadorWMS)
+    servidor.daemon_threads = True
+    return servidor
+
+
+_servidor = None
+
+
+def iniciar_en_segundo_plano(host=HOST, puerto=PUERTO):
+    """Arranca (una vez por proceso) el proxy en un hilo en segundo plano."""
+    global _servidor
+    with _cache_lock:
+        if _servidor is None:
+            _servidor = crear_servidor(host, puerto)
+            threading.Thread(target=_servidor.serve_forever, name="proxy_wms", daemon=True).start()
+        return _servidor
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Proxy con caché en disco para las imágenes WMS del mapa")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--puerto", type=int, default=PUERTO)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    servidor = crear_servidor(args.host, args.puerto)
+    logger.info("Escuchando en http://%s:%d/wms (caché en %s)", args.host, args.puerto, CACHE_DIR)
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
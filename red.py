@@ -0,0 +1,151 @@
+import os
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
+
+# Cortocircuito por servidor: fallos seguidos para abrirlo y segundos hasta volver a probar
+FALLOS_PARA_ABRIR = int(os.environ.get("AFECCIONES_CIRCUITO_FALLOS", "3"))
+ESPERA_CIRCUITO = float(os.environ.get("AFECCIONES_CIRCUITO_ESPERA_S", "60"))
+
+
+class CircuitoAbierto(requests.exceptions.ConnectionError):
+    """El servidor ha fallado repetidamente: la petición se rechaza sin enviarla."""
+
+
+# === CORTOCIRCUITO POR SERVIDOR ===
+class Circuito:
+    """
+    Estados:
+    - cerrado: las peticiones pasan; FALLOS_PARA_ABRIR fallos seguidos lo abren
+    - abierto: se rechazan al instante durante 'espera' segundos
+    - semiabierto: pasado ese tiempo se deja pasar una única petición de prueba;
+      si va bien se cierra, si falla vuelve a abrirse
+    """
+
+    def __init__(self, fallos_para_abrir=FALLOS_PARA_ABRIR, espera=ESPERA_CIRCUITO):
+        self.fallos_para_abrir = fallos_para_abrir
+        self.espera = espera
+        self.fallos = 0
+        self.abierto_desde = None
+        self.probando = False
+        self.abierto = threading.Event()  # Despierta a los reintentos que esperan su backoff
+        self._lock = threading.Lock()
+
+    @property
+    def estado(self):
+        if self.abierto_desde is None:
+            return "cerrado"
+        if time.monotonic() - self.abierto_desde < self.espera:
+            return "abierto"
+        return "semiabierto"
+
+    def permitir(self):
+        """True si la petición puede enviarse (en semiabierto, solo la primera)."""
+        with self._lock:
+            estado = self.estado
+            if estado == "cerrado":
+                return True
+            if estado == "semiabierto" and not self.probando:
+                self.probando = True
+                return True
+            return False
+
+    def exito(self):
+        with self._lock:
+            self.fallos = 0
+            self.abierto_desde = None
+            self.probando = False
+            self.abierto.clear()
+
+    def fallo(self):
+        with self._lock:
+            self.fallos += 1
+            if self.probando or self.fallos >= self.fallos_para_abrir:
+                self.abierto_desde = time.monotonic()
+                self.abierto.set()
+            self.probando = False
+
+
+_circuitos = {}
+_circuitos_lock = threading.Lock()
+# Intentos fallidos de la petición en curso en cada hilo (los registra ReintentosConCircuito)
+_intentos = threading.local()
+_PUERTOS = {"http": 80, "https": 443}
+
+
+def circuito(url):
+    """Circuito del servidor (host y puerto) de una URL."""
+    partes = urlparse(url)
+    clave = (partes.hostname, partes.port or _PUERTOS.get(partes.scheme))
+    with _circuitos_lock:
+        return _circuitos.setdefault(clave, Circuito())
+
+
+class ReintentosConCircuito(Retry):
+    """
+    Retry que registra cada intento fallido (error de conexión o estado de
+    status_forcelist) en el circuito del servidor, no solo el resultado final
+    tras agotar los reintentos, y deja de reintentar en cuanto el circuito se
+    abre, también a mitad del backoff: durante una caída no se espera el
+    backoff completo en cada capa.
+    """
+
+    circuito = None  # El del servidor, en los Retry que devuelve increment tras un fallo
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        estado = None
+        reintentable = response is not None and response.status in (self.status_forcelist or ())
+        if _pool is not None and (error is not None or reintentable):
+            estado = circuito(f"{_pool.scheme}://{_pool.host}:{_pool.port}")
+            estado.fallo()
+            _intentos.fallidos = getattr(_intentos, "fallidos", 0) + 1
+        nuevo = super().increment(method, url, response, error, _pool, _stacktrace)
+        if estado is not None and estado.estado != "cerrado":
+            motivo = error or ResponseError(ResponseError.SPECIFIC_ERROR.format(status_code=response.status))
+            raise MaxRetryError(_pool, url, motivo)
+        nuevo.circuito = estado
+        return nuevo
+
+    def sleep(self, response=None):
+        if self.circuito is None:
+            return super().sleep(response)
+        espera = self.get_retry_after(response) if self.respect_retry_after_header and response else None
+        if self.circuito.abierto.wait(self.get_backoff_time() if espera is None else espera):
+            raise MaxRetryError(None, None, ResponseError("circuito abierto durante la espera"))
+
+
+class AdaptadorConCircuito(HTTPAdapter):
+    """HTTPAdapter que consulta el circuito del servidor antes de cada petición."""
+
+    def send(self, request, **kwargs):
+        estado = circuito(request.url)
+        if not estado.permitir():
+            raise CircuitoAbierto(f"Servidor no disponible (circuito abierto): {urlparse(request.url).netloc}")
+        _intentos.fallidos = 0
+        # El resultado se registra siempre (finally): si la petición de prueba lanzara algo
+        # que no es RequestException, 'probando' quedaría activo y el circuito abierto para siempre.
+        # Un fallo ya registrado intento a intento por ReintentosConCircuito no se cuenta otra vez
+        correcta = False
+        try:
+            response = super().send(request, **kwargs)
+            correcta = response.status_code < 500
+            return response
+        finally:
+            if correcta:
+                estado.exito()
+            elif not _intentos.fallidos:
+                estado.fallo()
+
+
+# Sesión segura con reintentos (compartida por todas las descargas)
+session = requests.Session()
+retry = ReintentosConCircuito(total=3, backoff_factor=2, status_forcelist=[500, 502, 503, 504, 429])
+# Pool amplio: las capas WFS de un informe se consultan en paralelo contra el mismo servidor
+adapter = AdaptadorConCircuito(max_retries=retry, pool_maxsize=16)
+session.mount('http://', adapter)
+session.mount('https://', adapter)
@@ -0,0 +1,137 @@
+"""
+API HTTP/JSON local del motor de afecciones (sin Streamlit):
+
+    GET /afecciones?x=616500&y=4210500          punto ETRS89 UTM 30N
+    GET /afecciones?x=-1.7&y=38.05&crs=EPSG:4326  punto en otro sistema (23030, 4326)
+    GET /parcela/<municipio>/<polígono>/<parcela>  parcela completa
+    GET /salud                                   estado del almacén
+
+Todas las peticiones comparten el almacén del proceso: cada capa se parsea y
+se indexa una sola vez y las parcelas de cada municipio se leen una vez.
+
+    python servidor.py [--host 127.0.0.1] [--puerto 8000]
+"""
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+from afecciones import (
+    _valor_json, calentar_caches, cargar_municipio, como_json, evaluar, localizar_parcela, localizar_punto,
+    resolver_municipio,
+)
+from almacen import cache
+
+logger = logging.getLogger(__name__)
+
+HOST = os.environ.get("AFECCIONES_API_HOST", "127.0.0.1")
+PUERTO = int(os.environ.get("AFECCIONES_API_PUERTO", "8000"))
+# Hilos para evaluar capas, compartidos por todas las peticiones (no un pool de 15 hilos por petición)
+HILOS_CAPAS = int(os.environ.get("AFECCIONES_API_HILOS", "16"))
+
+_pool_capas = ThreadPoolExecutor(max_workers=HILOS_CAPAS, thread_name_prefix="capas")
+
+
+class ErrorPeticion(Exception):
+    """Error que se devuelve al cliente con su código HTTP."""
+
+    def __init__(self, codigo, mensaje):
+        super().__init__(mensaje)
+        self.codigo = codigo
+
+
+# === RUTAS ===
+def _coordenada(parametros, nombre):
+    try:
+        return float(parametros[nombre][0].replace(",", "."))
+    except (KeyError, IndexError, ValueError):
+        raise ErrorPeticion(400, f"Parámetro '{nombre}' ausente o no numérico")
+
+
+def consulta_punto(parametros):
+    x, y = _coordenada(parametros, "x"), _coordenada(parametros, "y")
+    try:
+        localizacion = localizar_punto(x, y, parametros.get("crs", [None])[0])
+    except ValueError as e:  # Sistema no admitido o coordenadas fuera de rango
+        raise ErrorPeticion(400, str(e))
+    return como_json(localizacion, evaluar(localizacion, pool=_pool_capas))
+
+
+def consulta_parcela(municipio, masa, parcela):
+    try:
+        # En un proceso de larga vida compensa cargar el municipio entero una vez
+        # (con su sindex, compartido con /afecciones) en vez de leer un registro por petición
+        cargar_municipio(resolver_municipio(municipio)[1])
+        localizacion = localizar_parcela(municipio, masa, parcela)
+    except ValueError as e:
+        raise ErrorPeticion(404, str(e))
+    return como_json(localizacion, evaluar(localizacion, pool=_pool_capas))
+
+
+def responder(ruta, parametros):
+    """(código HTTP, cuerpo) de una petición GET."""
+    partes = [unquote(parte) for parte in ruta.strip("/").split("/") if parte]
+    if partes == ["afecciones"]:
+        return 200, consulta_punto(parametros)
+    if len(partes) == 4 and partes[0] == "parcela":
+        return 200, consulta_parcela(*partes[1:])
+    if partes == ["salud"]:
+        return 200, {"estado": "ok", "almacen": cache.estadisticas()}
+    raise ErrorPeticion(404, f"Ruta desconocida: {ruta}")
+
+
+# === SERVIDOR ===
+class ManejadorAfecciones(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Conexiones persistentes para clientes que hacen muchas consultas
+
+    def do_GET(self):
+        inicio = time.perf_counter()
+        url = urlparse(self.path)
+        try:
+            codigo, cuerpo = responder(url.path, parse_qs(url.query))
+        except ErrorPeticion as e:
+            codigo, cuerpo = e.codigo, {"error": str(e)}
+        except Exception as e:
+            logger.exception("Error en %s", self.path)
+            codigo, cuerpo = 500, {"error": str(e)}
+        datos = json.dumps(cuerpo, ensure_ascii=False, default=_valor_json).encode("utf-8")
+        self.send_response(codigo)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(datos)))
+        self.end_headers()
+        self.wfile.write(datos)
+        logger.info("%s %s %d %.1f ms", self.command, self.path, codigo, (time.perf_counter() - inicio) * 1000)
+
+    def log_message(self, formato, *args):
+        pass  # Cada petición ya se registra con logging en do_GET
+
+
+def crear_servidor(host=HOST, puerto=PUERTO, calentar=True):
+    """Servidor (un hilo por conexión) listo para serve_forever(); calienta las capas sin red."""
+    if calentar:
+        calentar_caches()
+    servidor = ThreadingHTTPServer((host, puerto), ManejadorAfecciones)
+    servidor.daemon_threads = True
+    return servidor
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="API HTTP/JSON de afecciones")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--puerto", type=int, default=PUERTO)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    servidor = crear_servidor(args.host, args.puerto)
+    logger.info("Escuchando en http://%s:%d", args.host, args.puerto)
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
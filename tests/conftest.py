@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# Los módulos de la app están en la raíz del repositorio
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Sin instantáneas ni cachés en disco del repositorio: cada ejecución parte de cero
+os.environ.setdefault("AFECCIONES_INSTANTANEAS_DIR", tempfile.mkdtemp(prefix="instantaneas_"))
+os.environ.setdefault("AFECCIONES_LOCALES_PARQUET_DIR", tempfile.mkdtemp(prefix="locales_"))
+os.environ.setdefault("AFECCIONES_ATLAS_DIR", tempfile.mkdtemp(prefix="atlas_"))
@@ -0,0 +1,71 @@
+import json
+import os
+import time
+
+import geopandas as gpd
+import pytest
+from shapely.geometry import Point
+
+import capas
+import instantaneas
+from almacen import cache
+from capas import AFECTA, INDETERMINADO, NO_AFECTA, datos_capa, evaluar_capa, wfs_urls
+
+# Punto cualquiera de la Región de Murcia (ETRS89 UTM 30N)
+PUNTO = Point(616500, 4210500)
+
+
+def descargar_falla(url, timeout=30):
+    raise ConnectionError("WFS caído")
+
+
+@pytest.fixture(autouse=True)
+def sin_instantaneas(monkeypatch):
+    monkeypatch.setattr(capas, "cargar_instantanea", lambda clave, max_edad=None: None)
+
+
+@pytest.mark.parametrize("clave", ["enp", "mup"])
+def test_datos_capa_usa_copia_local_si_la_descarga_lanza(clave):
+    gdf = datos_capa(clave, PUNTO, wfs_urls[clave], descargar=descargar_falla)
+    assert gdf is not None and len(gdf) > 0
+
+
+def test_datos_capa_sin_copia_local_propaga_el_error():
+    with pytest.raises(ConnectionError):
+        datos_capa("flora", PUNTO, wfs_urls["flora"], descargar=descargar_falla)
+
+
+def test_evaluar_capa_con_descarga_fallida():
+    resultado = evaluar_capa("enp", PUNTO, wfs_urls["enp"], "ENP", campo_nombre="nombre", descargar=descargar_falla)
+    assert resultado.estado in (AFECTA, NO_AFECTA)
+
+    resultado = evaluar_capa("flora", PUNTO, wfs_urls["flora"], "FLORA", descargar=descargar_falla)
+    assert resultado.estado == INDETERMINADO and resultado.motivo == "error de datos"
+
+
+# === INSTANTÁNEAS CADUCADAS ===
+def geojson(nombre):
+    capa = gpd.GeoDataFrame({"nombre": [nombre]}, geometry=[PUNTO.buffer(50)], crs="EPSG:25830")
+    return capa.to_json().encode("utf-8")
+
+
+@pytest.fixture
+def instantanea_caducada(monkeypatch, tmp_path):
+    """Instantánea de 'flora' comprobada por última vez hace más de MAX_EDAD."""
+    cache.invalidar()  # Sin descargas WFS de otras pruebas
+    monkeypatch.setattr(instantaneas, "INSTANTANEAS_DIR", str(tmp_path))
+    monkeypatch.setattr(capas, "cargar_instantanea", instantaneas.cargar_instantanea)
+    meta = instantaneas.actualizar_instantanea("flora", wfs_urls["flora"], lambda url: geojson("instantanea"))
+    meta["comprobada"] = time.time() - instantaneas.MAX_EDAD - 60
+    with open(os.path.join(tmp_path, "flora", "actual.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+
+def test_datos_capa_con_instantanea_caducada_consulta_el_wfs(instantanea_caducada):
+    gdf = datos_capa("flora", PUNTO, wfs_urls["flora"], descargar=lambda url, timeout=30: geojson("wfs"))
+    assert list(gdf["nombre"]) == ["wfs"]
+
+
+def test_datos_capa_usa_la_instantanea_caducada_si_el_wfs_falla(instantanea_caducada):
+    gdf = datos_capa("flora", PUNTO, wfs_urls["flora"], descargar=descargar_falla)
+    assert list(gdf["nombre"]) == ["instantanea"]
@@ -0,0 +1,130 @@
+import json
+import threading
+import time
+from functools import partial
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import geopandas as gpd
+import pytest
+from shapely.geometry import Point
+
+import afecciones
+import capas
+import servidor
+from almacen import cache
+from capas import AFECTA, INDETERMINADO, NO_AFECTA
+from coordenadas import a_geograficas
+
+# Punto de la parcela 8/48 de Bullas (ETRS89 UTM 30N)
+X, Y = 616500, 4210500
+# Capas que el WFS simulado devuelve con un elemento sobre el punto; las demás, vacías
+AFECTADAS = {"flora", "zepa"}
+CAMPOS = {clave: opciones.get("campo_nombre") or "nombre" for clave, _, opciones in capas.consultas_afecciones}
+
+
+def descargar_simulado(url, timeout=30):
+    clave = next(clave for clave, base in capas.wfs_urls.items() if url.startswith(base))
+    geometrias = [Point(X, Y).buffer(500)] if clave in AFECTADAS else []
+    capa = gpd.GeoDataFrame(
+        {CAMPOS[clave]: [f"{clave} simulada"] * len(geometrias)}, geometry=geometrias, crs="EPSG:25830"
+    )
+    return capa.to_json().encode("utf-8")
+
+
+def descargar_lento(url, timeout=30):
+    time.sleep(1)
+    return descargar_simulado(url)
+
+
+@pytest.fixture
+def url_base(monkeypatch):
+    """Servidor en un puerto libre, sin red: el WFS se sustituye por descargar_simulado."""
+    cache.invalidar()
+    monkeypatch.setattr(capas, "cargar_instantanea", lambda clave, max_edad=None: None)
+    monkeypatch.setattr(capas, "descargar_capa", descargar_simulado)
+    http = servidor.crear_servidor("127.0.0.1", 0, calentar=False)
+    threading.Thread(target=http.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{http.server_address[1]}"
+    http.shutdown()
+    http.server_close()
+    cache.invalidar()
+
+
+def pedir(url):
+    """(código HTTP, cuerpo JSON) de un GET."""
+    try:
+        with urlopen(url, timeout=30) as respuesta:
+            return respuesta.status, json.loads(respuesta.read())
+    except HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def estados(cuerpo):
+    return {afeccion["clave"]: afeccion["estado"] for afeccion in cuerpo["afecciones"]}
+
+
+def test_afecciones_por_punto(url_base):
+    codigo, cuerpo = pedir(f"{url_base}/afecciones?x={X}&y={Y}")
+    assert codigo == 200
+    assert (cuerpo["municipio"], cuerpo["x"], cuerpo["y"]) == ("BULLAS", X, Y)
+    assert len(cuerpo["afecciones"]) == len(capas.consultas_afecciones)
+    resultado = estados(cuerpo)
+    assert all(resultado[clave] == AFECTA for clave in AFECTADAS)
+    assert resultado["tm"] == NO_AFECTA
+    flora = next(a for a in cuerpo["afecciones"] if a["clave"] == "flora")
+    assert [elemento[CAMPOS["flora"]] for elemento in flora["elementos"]] == ["flora simulada"]
+
+
+def test_afecciones_en_otro_sistema(url_base):
+    lon, lat = a_geograficas(X, Y)
+    codigo, cuerpo = pedir(f"{url_base}/afecciones?x={float(lon)}&y={float(lat)}&crs=EPSG:4326")
+    assert codigo == 200
+    assert cuerpo["x"] == pytest.approx(X, abs=0.01) and cuerpo["y"] == pytest.approx(Y, abs=0.01)
+
+
+def test_parcela(url_base):
+    codigo, cuerpo = pedir(f"{url_base}/parcela/Bullas/8/48")
+    assert codigo == 200
+    assert cuerpo["por_parcela"] and (cuerpo["municipio"], cuerpo["poligono"], cuerpo["parcela"]) == ("BULLAS", "008", "00048")
+    assert estados(cuerpo)["flora"] == AFECTA
+
+
+def test_salud(url_base):
+    pedir(f"{url_base}/afecciones?x={X}&y={Y}")
+    codigo, cuerpo = pedir(f"{url_base}/salud")
+    assert codigo == 200 and cuerpo["estado"] == "ok"
+    assert cuerpo["almacen"]["entradas"] > 0
+
+
+@pytest.mark.parametrize("ruta, codigo", [
+    ("/desconocida", 404),
+    ("/parcela/Bullas/8", 404),
+    ("/parcela/Atlantida/8/48", 404),
+    ("/parcela/Bullas/9999/1", 404),
+    ("/afecciones?x=616500", 400),
+    ("/afecciones?x=abc&y=4210500", 400),
+    ("/afecciones?x=100&y=100", 400),
+    ("/afecciones?x=616500&y=4210500&crs=EPSG:3857", 400),
+])
+def test_errores(url_base, ruta, codigo):
+    recibido, cuerpo = pedir(url_base + ruta)
+    assert recibido == codigo
+    assert cuerpo["error"]
+
+
+def test_plazo_con_el_pool_compartido(url_base, monkeypatch):
+    monkeypatch.setattr(capas, "descargar_capa", descargar_lento)
+    monkeypatch.setattr(servidor, "evaluar", partial(afecciones.evaluar, plazo=0.2))
+    inicio = time.perf_counter()
+    codigo, cuerpo = pedir(f"{url_base}/afecciones?x={X}&y={Y}")
+    assert time.perf_counter() - inicio < 1
+    assert codigo == 200
+    agotadas = [a for a in cuerpo["afecciones"] if a["motivo"] == "tiempo agotado"]
+    assert agotadas and all(a["estado"] == INDETERMINADO for a in agotadas)
+
+    # Las capas pendientes no bloquean el pool: la consulta siguiente, ya sin plazo, se completa
+    monkeypatch.setattr(capas, "descargar_capa", descargar_simulado)
+    monkeypatch.setattr(servidor, "evaluar", afecciones.evaluar)
+    codigo, cuerpo = pedir(f"{url_base}/afecciones?x={X}&y={Y}")
+    assert codigo == 200 and "tiempo agotado" not in {a["motivo"] for a in cuerpo["afecciones"]}